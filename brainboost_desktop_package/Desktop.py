@@ -1,24 +1,38 @@
 import os
-import json
+import atexit
+import collections
+import math
 import platform
+import re
 import sqlite3
 import subprocess
 import threading
 import io
 import queue
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List, Tuple
 import tempfile
 
 import cv2
 import numpy as np
+import orjson
 import pyautogui
 import pytesseract
+import zstandard as zstd
 from mss import mss
-from PIL import ImageGrab, Image
+from mss.exception import ScreenShotError
+from PIL import Image
 from screeninfo import get_monitors
 from pynput import keyboard, mouse
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 # Import or define any additional modules that your class depends on
 # These might be external or other internal packages:
 from brainboost_ocr_package.BBOcr import BBOcr
@@ -27,6 +41,7 @@ from brainboost_data_source_logger_package.BBLogger import BBLogger
 from brainboost_configuration_package.BBConfig import BBConfig
 
 if platform.system() == "Darwin":
+    import Quartz
     from Quartz import (
         CGWindowListCopyWindowInfo,
         kCGWindowListOptionOnScreenOnly,
@@ -38,6 +53,372 @@ if platform.system() == "Darwin":
 if platform.system() == "Windows":
     import pygetwindow as gw
 
+# Snapshot rows are committed by a background writer in batches of at most
+# _WRITE_BATCH_SIZE rows, pausing _WRITE_INTERVAL seconds between batches.
+_WRITE_BATCH_SIZE = 64
+_WRITE_INTERVAL = 0.05
+
+# A pixel counts as changed when any of its channels differs by more than this.
+_DIFF_THRESHOLD = 30
+
+# Changes are located on frames downscaled by this factor, and the resulting
+# box is padded by _DIFF_PAD full-resolution pixels on every side.
+_DIFF_SCALE = 4
+_DIFF_PAD = 8
+
+# Changes smaller than _MIN_DIFF_AREA full-resolution pixels, or where fewer
+# than _MIN_DIFF_DENSITY of the box's pixels changed, are not recorded.
+# Overridable through the min_diff_area and min_diff_density config keys.
+_MIN_DIFF_AREA = 2000
+_MIN_DIFF_DENSITY = 0.02
+
+# Snapshot blobs are a magic/version tag and a (height, width, channels)
+# header followed by the zstd-compressed raw uint8 pixels. Rows written by
+# older versions hold PNG bytes instead, recognised by the PNG signature.
+_BLOB_MAGIC = b"BBZ\x01"
+_BLOB_HEADER = struct.Struct("<4sHHB")
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Columns added to the snapshots table after its original schema, each group
+# with the statement that backfills it for rows written by older versions.
+# Legacy ISO timestamps are naive local time; they are converted to UTC and
+# backfilled at millisecond precision.
+_SNAPSHOT_MIGRATIONS = (
+    (("ts_ns",), """
+        UPDATE snapshots
+        SET ts_ns = CAST(ROUND((julianday(timestamp, 'utc') - 2440587.5) * 86400000) AS INTEGER) * 1000000
+        WHERE timestamp IS NOT NULL
+    """),
+    (("x", "y", "w", "h"), """
+        UPDATE snapshots
+        SET x = json_extract(position, '$.x'),
+            y = json_extract(position, '$.y'),
+            w = json_extract(position, '$.width'),
+            h = json_extract(position, '$.height')
+        WHERE position IS NOT NULL
+    """),
+)
+
+# mss caches monitor geometry forever; it is re-queried at most this often, in
+# seconds, so monitors being plugged in, removed or resized are picked up.
+_MONITOR_REFRESH_INTERVAL = 2.0
+
+# Maximum number of diffs waiting for OCR; further frames are skipped until the
+# OCR worker catches up, so capture never blocks on tesseract.
+_MAX_PENDING_OCR = 2
+
+# How long, in seconds, the most recent OCR result may be used by click_button
+# before it is considered stale.
+_OCR_CACHE_TTL = 0.5
+
+# Fused diff kernel: one pass over both frames computes the bounding box and
+# count of pixels whose largest channel difference exceeds the threshold,
+# without materializing a difference or mask image. Only used when numba is
+# installed.
+_diff_bbox_kernel = None
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _diff_bbox_kernel(base, new, threshold):
+        height, width, channels = new.shape
+        row_min = np.full(height, width, dtype=np.int64)
+        row_max = np.full(height, -1, dtype=np.int64)
+        row_count = np.zeros(height, dtype=np.int64)
+        for y in numba.prange(height):
+            for x in range(width):
+                for c in range(channels):
+                    a = base[y, x, c]
+                    b = new[y, x, c]
+                    if (a - b if a > b else b - a) > threshold:
+                        if row_max[y] < 0:
+                            row_min[y] = x
+                        row_max[y] = x
+                        row_count[y] += 1
+                        break
+
+        x0, y0, x1, y1 = width, -1, -1, -1
+        for y in range(height):
+            if row_max[y] >= 0:
+                if y0 < 0:
+                    y0 = y
+                y1 = y
+                x0 = min(x0, row_min[y])
+                x1 = max(x1, row_max[y])
+        if y0 < 0:
+            return 0, 0, 0, 0, 0
+        return x0, y0, x1 - x0 + 1, y1 - y0 + 1, row_count.sum()
+
+# Captured input events are kept as (kind, value, x, y, time_ns, repeat) tuples
+# in a bounded ring buffer and only formatted when a snapshot is saved.
+_INPUT_KEYBOARD = 0
+_INPUT_MOUSE = 1
+_INPUT_BUFFER_SIZE = 10000
+
+# Presses of the same key less than _KEY_REPEAT_WINDOW_NS apart (auto-repeat)
+# are coalesced into one event, emitted once the key has been idle for
+# _KEY_IDLE_FLUSH_NS or another input arrives.
+_KEY_REPEAT_WINDOW_NS = 50_000_000
+_KEY_IDLE_FLUSH_NS = 200_000_000
+
+# One line of `wmctrl -lG`: window id, desktop, x, y, width, height, host, title.
+_WMCTRL_RE = re.compile(
+    rb"^(\S+)[ \t]+\S+[ \t]+(-?\d+)[ \t]+(-?\d+)[ \t]+(\d+)[ \t]+(\d+)[ \t]+\S+[ \t]*(.*)$",
+    re.M
+)
+
+def _get_linux_windows():
+    try:
+        output = subprocess.check_output(["wmctrl", "-l"]).decode("utf-8").strip().split("\n")
+        windows = [{"id": line.split()[0], "title": line.split(None, 3)[-1]} for line in output]
+        return windows
+    except subprocess.CalledProcessError:
+        return []
+
+def _get_windows_windows():
+    windows = []
+    for win in gw.getAllWindows():
+        windows.append({
+            "title": win.title,
+            "left": win.left,
+            "top": win.top,
+            "width": win.width,
+            "height": win.height,
+        })
+    return windows
+
+def _get_darwin_windows():
+    window_list = CGWindowListCopyWindowInfo(kCGWindowListOptionOnScreenOnly, kCGNullWindowID)
+    windows = []
+    for window in window_list:
+        title = window.get("kCGWindowName", "Unknown")
+        bounds = window.get("kCGWindowBounds", {})
+        x = int(bounds.get("X", 0))
+        y = int(bounds.get("Y", 0))
+        width = int(bounds.get("Width", 0))
+        height = int(bounds.get("Height", 0))
+        windows.append({
+            "title": title,
+            "left": x,
+            "top": y,
+            "width": width,
+            "height": height,
+        })
+    return windows
+
+def _find_wmctrl_window(output, window_id):
+    # Compare ids numerically: xprop prints 0x2a00007, wmctrl pads it to 0x02a00007.
+    wanted = int(window_id, 16)
+    for match in _WMCTRL_RE.finditer(output):
+        if int(match.group(1), 16) == wanted:
+            return match
+    return None
+
+def _get_linux_focused_window():
+    try:
+        window_id = subprocess.check_output(["xprop", "-root", "_NET_ACTIVE_WINDOW"]).decode().strip()
+        window_id = window_id.split()[-1]
+
+        window_info = subprocess.check_output(["xwininfo", "-id", window_id]).decode().splitlines()
+        window_name = ""
+        for line in window_info:
+            if "xwininfo" in line and "-name" in line:
+                window_name = line.split('"', 1)[-1].strip().strip('"')
+                break
+        window = {"title": window_name, "id": window_id}
+
+        # Geometry comes from the same `wmctrl -lG` listing the other helpers use.
+        match = _find_wmctrl_window(subprocess.check_output(["wmctrl", "-lG"]), window_id)
+        if match:
+            window["left"], window["top"], window["width"], window["height"] = (
+                int(value) for value in match.group(2, 3, 4, 5)
+            )
+        return window
+    except Exception as e:
+        BBLogger.log(f"Error retrieving focused window on Linux: {e}")
+        return None
+
+def _get_windows_focused_window():
+    try:
+        active_window = gw.getActiveWindow()
+        if active_window:
+            return {
+                "title": active_window.title,
+                "left": active_window.left,
+                "top": active_window.top,
+                "width": active_window.width,
+                "height": active_window.height,
+            }
+        else:
+            BBLogger.log("No active window found.")
+            return None
+    except Exception as e:
+        BBLogger.log(f"Error retrieving focused window on Windows: {e}")
+        return None
+
+def _get_darwin_focused_window():
+    try:
+        window_list = CGWindowListCopyWindowInfo(
+            kCGWindowListOptionOnScreenAbove, CGMainDisplayID()
+        )
+        for window in window_list:
+            if window.get("kCGWindowIsOnscreen") and window.get("kCGWindowName"):
+                bounds = window["kCGWindowBounds"]
+                return {
+                    "title": window.get("kCGWindowName"),
+                    "left": int(bounds["X"]),
+                    "top": int(bounds["Y"]),
+                    "width": int(bounds["Width"]),
+                    "height": int(bounds["Height"]),
+                }
+        BBLogger.log("No focused window found.")
+        return None
+    except Exception as e:
+        BBLogger.log(f"Error retrieving focused window on macOS: {e}")
+        return None
+
+def _take_screenshot_linux(desktop, name):
+    try:
+        output = subprocess.check_output(["wmctrl", "-lG"])
+        encoded_name = name.encode("utf-8")
+        for match in _WMCTRL_RE.finditer(output):
+            if encoded_name in match.group(6):
+                x, y, width, height = (int(value) for value in match.group(2, 3, 4, 5))
+                break
+        else:
+            BBLogger.log(f"Window '{name}' not found.")
+            return None
+
+        return desktop._grab_window_region(name, x, y, width, height)
+    except Exception as e:
+        BBLogger.log(f"Error capturing screenshot on Linux: {e}")
+        return None
+
+def _take_screenshot_windows(desktop, name):
+    try:
+        window = gw.getWindowsWithTitle(name)
+        if not window:
+            BBLogger.log(f"Window '{name}' not found.")
+            return None
+        window = window[0]
+        return desktop._grab_window_region(name, window.left, window.top, window.width, window.height)
+    except Exception as e:
+        BBLogger.log(f"Error capturing screenshot on Windows: {e}")
+        return None
+
+def _take_screenshot_macos(desktop, name):
+    try:
+        window_info_list = CGWindowListCopyWindowInfo(
+            kCGWindowListOptionOnScreenOnly, kCGNullWindowID
+        )
+        for window in window_info_list:
+            if window.get("kCGWindowName") == name:
+                bounds = window["kCGWindowBounds"]
+                x, y = int(bounds["X"]), int(bounds["Y"])
+                width, height = int(bounds["Width"]), int(bounds["Height"])
+
+                image = Quartz.CGWindowListCreateImage(
+                    (x, y, width, height),
+                    Quartz.kCGWindowListOptionOnScreenOnly,
+                    Quartz.kCGNullWindowID,
+                    Quartz.kCGWindowImageDefault
+                )
+
+                if image:
+                    data = Quartz.CGDataProviderCopyData(Quartz.CGImageGetDataProvider(image))
+                    pil_image = Image.open(io.BytesIO(data))
+                    pil_image.save(f"{name}_screenshot.png")
+                    BBLogger.log(f"Screenshot saved as {name}_screenshot.png")
+                    return pil_image
+                break
+        else:
+            BBLogger.log(f"Window '{name}' not found.")
+            return None
+    except Exception as e:
+        BBLogger.log(f"Error capturing screenshot on macOS: {e}")
+        return None
+
+def _get_linux_window_coordinates():
+    try:
+        # `wmctrl -lG` reports the geometry of every window in one call.
+        output = subprocess.check_output(["wmctrl", "-lG"])
+        return [
+            {
+                "title": match.group(6).decode("utf-8", errors="replace"),
+                "left": int(match.group(2)),
+                "top": int(match.group(3)),
+                "width": int(match.group(4)),
+                "height": int(match.group(5))
+            } for match in _WMCTRL_RE.finditer(output)
+        ]
+    except subprocess.CalledProcessError as e:
+        BBLogger.log(f"Error retrieving window coordinates on Linux: {e}")
+        return []
+
+def _get_windows_window_coordinates():
+    windows = []
+    for win in gw.getAllWindows():
+        windows.append({
+            "title": win.title,
+            "left": win.left,
+            "top": win.top,
+            "width": win.width,
+            "height": win.height
+        })
+    return windows
+
+def _get_darwin_window_coordinates():
+    try:
+        windows = []
+        window_list = CGWindowListCopyWindowInfo(
+            kCGWindowListOptionOnScreenOnly, kCGNullWindowID
+        )
+        for window in window_list:
+            title = window.get("kCGWindowName", "Unknown")
+            bounds = window.get("kCGWindowBounds", {})
+            x = int(bounds.get("X", 0))
+            y = int(bounds.get("Y", 0))
+            width = int(bounds.get("Width", 0))
+            height = int(bounds.get("Height", 0))
+            windows.append({
+                "title": title,
+                "left": x,
+                "top": y,
+                "width": width,
+                "height": height
+            })
+        return windows
+    except Exception as e:
+        BBLogger.log(f"Error retrieving window coordinates on macOS: {e}")
+        return []
+
+# Per-platform implementations of the window helpers, resolved once per
+# Desktop instance instead of branching on the platform at every call.
+_PLATFORM_IMPLS = {
+    "Linux": {
+        "open_windows": _get_linux_windows,
+        "focused_window": _get_linux_focused_window,
+        "screenshot_from_window": _take_screenshot_linux,
+        "window_coordinates": _get_linux_window_coordinates,
+    },
+    "Windows": {
+        "open_windows": _get_windows_windows,
+        "focused_window": _get_windows_focused_window,
+        "screenshot_from_window": _take_screenshot_windows,
+        "window_coordinates": _get_windows_window_coordinates,
+    },
+    "Darwin": {
+        "open_windows": _get_darwin_windows,
+        "focused_window": _get_darwin_focused_window,
+        "screenshot_from_window": _take_screenshot_macos,
+        "window_coordinates": _get_darwin_window_coordinates,
+    },
+}
+
+def _not_implemented(*args):
+    raise NotImplementedError("This method is only implemented for Linux, Windows, and macOS.")
+
+_UNSUPPORTED_IMPL = dict.fromkeys(_PLATFORM_IMPLS["Linux"], _not_implemented)
+
+
 class Desktop:
     _instance = None  # Singleton instance
     _lock = threading.Lock()  # Lock for thread-safe creation
@@ -46,62 +427,204 @@ class Desktop:
         if Desktop._instance is not None:
             raise RuntimeError("Use get_desktop_singleton() to access the Desktop instance.")
         self.system = platform.system()
+        self._platform_impl = _PLATFORM_IMPLS.get(self.system, _UNSUPPORTED_IMPL)
         self.base_image = None
-        self.init_database()
-        self.conn = sqlite3.connect(BBConfig.get('snapshots_database_path'), check_same_thread=False)
+        # mss keeps its platform capture handles (X11 display, GDI DCs) in
+        # thread-local storage, so each capturing thread gets its own
+        # long-lived instance, created on first use by _get_sct().
+        self._sct_local = threading.local()
+        self._sct_lock = threading.Lock()
+        self._frame_bgr = None
+        self._frame_layout = None
+        # (canvas y, band height, screen left, screen top) per captured band
+        self._frame_origins = ()
+        self._diff_frame_shape = None
+        self._diff_mask = None
         self.lock = threading.Lock()
+        self.init_database()
         self.ocr = BBOcr()
-        self.user_input_queue = queue.Queue()
+        if _diff_bbox_kernel is not None:
+            # Pay the JIT compile cost up front rather than on the first capture.
+            warmup = np.zeros((16, 16, 3), dtype=np.uint8)
+            _diff_bbox_kernel(warmup, warmup, _DIFF_THRESHOLD)
+        self._zctx = zstd.ZstdCompressor(level=3, threads=-1)
+        self._ocr_executor = ThreadPoolExecutor(max_workers=1)
+        self._ocr_slots = threading.BoundedSemaphore(_MAX_PENDING_OCR)
+        self._last_ocr = None
+        self._input_buf = collections.deque(maxlen=_INPUT_BUFFER_SIZE)
+        self._pending_key = None
+        self._key_lock = threading.Lock()
+        self._debug_input_log = BBConfig.get('debug_input_log')
+        min_diff_area = BBConfig.get('min_diff_area')
+        self._min_diff_area = _MIN_DIFF_AREA if min_diff_area is None else min_diff_area
+        min_diff_density = BBConfig.get('min_diff_density')
+        self._min_diff_density = _MIN_DIFF_DENSITY if min_diff_density is None else min_diff_density
         self.monitoring_user_input = False
 
         # Start user input monitoring if enabled
-        BBConfig.override('monitor_user_input', True)
         if BBConfig.get('monitor_user_input'):
             self.monitoring_user_input = True
             threading.Thread(target=self._monitor_user_input, daemon=True).start()
 
+        # The database writer is a daemon thread; close() at exit lets it drain
+        # the queued rows instead of being killed mid-batch.
+        atexit.register(self.close)
+
     def init_database(self):
+        self.conn = None
         if BBConfig.get('snapshots_database_enabled'):
-            self.conn = sqlite3.connect(BBConfig.get('snapshots_database_path'))
-            cursor = self.conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS snapshots (
-                    id INTEGER PRIMARY KEY,
-                    type TEXT,
-                    timestamp TEXT,
-                    data BLOB,
-                    position TEXT,
-                    text TEXT,
-                    user_input TEXT
-                )
-            """)
-            self.conn.commit()
+            # A single long-lived connection in autocommit mode; transactions are
+            # opened explicitly by the writer thread so that rows are batched.
+            self.conn = sqlite3.connect(
+                BBConfig.get('snapshots_database_path'),
+                check_same_thread=False,
+                isolation_level=None
+            )
+            with self.lock:
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute("PRAGMA synchronous=NORMAL")
+                self.conn.execute("PRAGMA temp_store=MEMORY")
+                self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS snapshots (
+                        id INTEGER PRIMARY KEY,
+                        type TEXT,
+                        timestamp TEXT,
+                        data BLOB,
+                        position TEXT,
+                        text TEXT,
+                        user_input TEXT,
+                        ts_ns INTEGER,
+                        x INTEGER,
+                        y INTEGER,
+                        w INTEGER,
+                        h INTEGER
+                    )
+                """)
+                self._migrate_database()
+            self._insert_stmt = (
+                "INSERT INTO snapshots (ts_ns, type, data, x, y, w, h, text, user_input) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+            )
+            self._write_queue = queue.Queue()
+            self._db_writer_thread = threading.Thread(target=self._db_writer, daemon=True)
+            self._db_writer_thread.start()
+
+    def _migrate_database(self):
+        # Older databases lack the INTEGER columns added since the original
+        # schema; add them and backfill from the legacy TEXT columns.
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(snapshots)")}
+        for added_columns, backfill in _SNAPSHOT_MIGRATIONS:
+            missing = [column for column in added_columns if column not in columns]
+            if not missing:
+                continue
+            self.conn.execute("BEGIN")
+            for column in missing:
+                self.conn.execute(f"ALTER TABLE snapshots ADD COLUMN {column} INTEGER")
+            self.conn.execute(backfill)
+            self.conn.execute("COMMIT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_snapshots_ts_ns ON snapshots (ts_ns)")
 
     def get_thread_safe_connection(self):
         return sqlite3.connect(BBConfig.get('snapshots_database_path'))
 
+    def _db_writer(self):
+        running = True
+        while running:
+            # Block for the first row, then drain whatever else is already queued.
+            rows = [self._write_queue.get()]
+            while len(rows) < _WRITE_BATCH_SIZE:
+                try:
+                    rows.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # A None row is the shutdown sentinel posted by close().
+            if None in rows:
+                running = False
+                rows = [row for row in rows if row is not None]
+
+            # A row that cannot be encoded is logged and dropped; it must not
+            # take down the writer and leave the queue growing unbounded.
+            serialized = []
+            for row in rows:
+                try:
+                    serialized.append(self._serialize_row(row))
+                except Exception as e:
+                    BBLogger.log(f"Error serializing snapshot row: {e}")
+
+            if serialized:
+                self._write_rows(serialized)
+
+            if running:
+                time.sleep(_WRITE_INTERVAL)
+
+    def _serialize_row(self, row):
+        # Queued rows carry raw OCR results and input events; JSON encoding
+        # happens here so it overlaps with capture instead of delaying it.
+        ts_ns, snapshot_type, data, x, y, w, h, ocr_results, user_inputs = row
+        return (
+            ts_ns,
+            snapshot_type,
+            data,
+            x,
+            y,
+            w,
+            h,
+            orjson.dumps(ocr_results, option=orjson.OPT_SERIALIZE_NUMPY).decode(),
+            orjson.dumps(self._format_user_inputs(user_inputs)).decode()
+        )
+
+    def _write_rows(self, rows):
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN")
+                self.conn.executemany(self._insert_stmt, rows)
+                self.conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                BBLogger.log(f"Error writing {len(rows)} snapshot rows: {e}")
+                if self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
+
+    def close(self):
+        atexit.unregister(self.close)
+        # Forget the singleton first, so get_desktop_singleton() builds a fresh
+        # instance instead of handing out this closed one.
+        with Desktop._lock:
+            if Desktop._instance is self:
+                Desktop._instance = None
+        self._ocr_executor.shutdown(wait=True)
+        with self._sct_lock:
+            # mss handles can only be released by the thread that opened them;
+            # instances owned by other threads are released at process exit.
+            sct = getattr(self._sct_local, "sct", None)
+            if sct is not None:
+                sct.close()
+                self._sct_local.sct = None
+        if self.conn is None:
+            return
+        self._write_queue.put(None)
+        self._db_writer_thread.join()
+        with self.lock:
+            self.conn.close()
+            self.conn = None
+
     def _monitor_user_input(self):
+        # Listener callbacks only append a tuple to the deque; no formatting
+        # happens on the listener threads.
         def on_key_press(key):
             try:
-                input_data = {
-                    "type": "keyboard",
-                    "value": str(key),
-                    "timestamp": datetime.now().isoformat()
-                }
-                BBLogger.log(f"Captured key press: {input_data}")
-                self.user_input_queue.put(input_data)
+                if self._record_key_press(str(key), time.time_ns()) and self._debug_input_log:
+                    BBLogger.log(f"Captured key press: {key}")
             except Exception as e:
                 BBLogger.log(f"Error in key press handler: {e}")
 
         def on_mouse_click(x, y, button, pressed):
-            input_data = {
-                "type": "mouse",
-                "value": "click" if pressed else "release",
-                "position": {"x": x, "y": y},
-                "timestamp": datetime.now().isoformat()
-            }
-            BBLogger.log(f"Captured mouse event: {input_data}")
-            self.user_input_queue.put(input_data)
+            value = "click" if pressed else "release"
+            with self._key_lock:
+                self._flush_pending_key()
+            self._input_buf.append((_INPUT_MOUSE, value, x, y, time.time_ns(), 1))
+            if self._debug_input_log:
+                BBLogger.log(f"Captured mouse event: {value} at ({x}, {y})")
 
         try:
             with keyboard.Listener(on_press=on_key_press) as key_listener, \
@@ -111,66 +634,232 @@ class Desktop:
         except Exception as e:
             BBLogger.log(f"Error starting listeners: {e}")
 
+    def _record_key_press(self, value, now):
+        # Returns False when the press is an auto-repeat folded into the
+        # pending key, True when it starts a new pending key.
+        with self._key_lock:
+            pending = self._pending_key
+            if pending is not None and pending[0] == value and now - pending[2] < _KEY_REPEAT_WINDOW_NS:
+                pending[1] += 1
+                pending[2] = now
+                return False
+            self._flush_pending_key()
+            # [value, repeat count, last press ns, first press ns]
+            self._pending_key = [value, 1, now, now]
+            return True
+
+    def _flush_pending_key(self):
+        # Caller holds self._key_lock.
+        if self._pending_key is not None:
+            value, repeat, _, first_ns = self._pending_key
+            self._input_buf.append((_INPUT_KEYBOARD, value, 0, 0, first_ns, repeat))
+            self._pending_key = None
+
     def _save_user_input(self):
+        with self._key_lock:
+            if self._pending_key is not None and time.time_ns() - self._pending_key[2] >= _KEY_IDLE_FLUSH_NS:
+                self._flush_pending_key()
+
+        # Drain the raw event tuples; they are formatted by the writer thread.
+        user_inputs = []
+        while True:
+            try:
+                user_inputs.append(self._input_buf.popleft())
+            except IndexError:
+                break
+        return user_inputs
+
+    @staticmethod
+    def _format_user_inputs(events):
         user_inputs = []
-        while not self.user_input_queue.empty():
-            user_inputs.append(self.user_input_queue.get())
+        for kind, value, x, y, time_ns, repeat in events:
+            input_data = {
+                "type": "keyboard" if kind == _INPUT_KEYBOARD else "mouse",
+                "value": value
+            }
+            if kind == _INPUT_MOUSE:
+                input_data["position"] = {"x": x, "y": y}
+            if repeat > 1:
+                input_data["repeat"] = repeat
+            input_data["timestamp"] = datetime.fromtimestamp(time_ns / 1e9).isoformat()
+            user_inputs.append(input_data)
         return user_inputs
 
+    def _reset_diff_buffers(self, new_img):
+        # Diff buffers are sized to the current frame geometry and only
+        # reallocated when it changes (e.g. a monitor is plugged in). The base
+        # image is kept at detection scale; full resolution is only needed for
+        # the crop, which is taken from the new frame.
+        height, width, channels = new_img.shape
+        small_size = (max(1, width // _DIFF_SCALE), max(1, height // _DIFF_SCALE))
+        self._diff_frame_shape = new_img.shape
+        self.base_image = cv2.resize(new_img, small_size, interpolation=cv2.INTER_AREA)
+        self._new_small = np.empty_like(self.base_image)
+        small_height, small_width = self.base_image.shape[:2]
+        self._diff_mask = np.empty((small_height, small_width * channels), dtype=np.uint8)
+        self._diff_rows = np.empty((small_height, 1), dtype=np.uint8)
+        self._diff_cols = np.empty((1, small_width * channels), dtype=np.uint8)
+
+    def _scale_bbox(self, x, y, w, h):
+        # Map a box found on the downscaled frames back to full resolution,
+        # padded to cover pixels that the area filter blurred across cells.
+        full_height, full_width = self._diff_frame_shape[:2]
+        small_height, small_width = self.base_image.shape[:2]
+        scale_x = full_width / small_width
+        scale_y = full_height / small_height
+        x0 = max(0, math.floor(x * scale_x) - _DIFF_PAD)
+        y0 = max(0, math.floor(y * scale_y) - _DIFF_PAD)
+        x1 = min(full_width, math.ceil((x + w) * scale_x) + _DIFF_PAD)
+        y1 = min(full_height, math.ceil((y + h) * scale_y) + _DIFF_PAD)
+        return x0, y0, x1 - x0, y1 - y0
+
+    def _diff_bbox(self, base_img, new_img):
+        if _diff_bbox_kernel is not None:
+            return _diff_bbox_kernel(base_img, new_img, _DIFF_THRESHOLD)
+
+        height, width, channels = new_img.shape
+
+        # View both frames as single-channel (H, W*C) planes so the per-channel
+        # difference and threshold run as one SIMD pass each, written into the
+        # preallocated mask.
+        base_plane = base_img.reshape(height, width * channels)
+        new_plane = new_img.reshape(height, width * channels)
+
+        cv2.absdiff(base_plane, new_plane, dst=self._diff_mask)
+        cv2.threshold(self._diff_mask, _DIFF_THRESHOLD, 255, cv2.THRESH_BINARY, dst=self._diff_mask)
+
+        # Row activity bounds the box vertically; column activity is then only
+        # reduced over the band of rows that changed.
+        cv2.reduce(self._diff_mask, 1, cv2.REDUCE_MAX, dst=self._diff_rows)
+        ys = np.flatnonzero(self._diff_rows)
+        if ys.size == 0:
+            return 0, 0, 0, 0, 0
+        y0, y1 = int(ys[0]), int(ys[-1])
+        cv2.reduce(self._diff_mask[y0:y1 + 1], 0, cv2.REDUCE_MAX, dst=self._diff_cols)
+        xs = np.flatnonzero(self._diff_cols)
+
+        # Map the bounding box from channel columns back to pixel columns, and
+        # count a pixel as changed when any of its channels changed, exactly as
+        # the numba kernel does.
+        x0 = int(xs[0]) // channels
+        x1 = int(xs[-1]) // channels
+        box = self._diff_mask[y0:y1 + 1, x0 * channels:(x1 + 1) * channels]
+        changed = np.count_nonzero(box.reshape(y1 - y0 + 1, x1 - x0 + 1, channels).max(axis=2))
+        return x0, y0, x1 - x0 + 1, y1 - y0 + 1, changed
+
+    def _encode_snapshot_blob(self, image):
+        height, width, channels = image.shape
+        header = _BLOB_HEADER.pack(_BLOB_MAGIC, height, width, channels)
+        return header + self._zctx.compress(np.ascontiguousarray(image).tobytes())
+
+    @staticmethod
+    def decode_snapshot_blob(blob):
+        if blob[:len(_PNG_SIGNATURE)] == _PNG_SIGNATURE:
+            return cv2.imdecode(np.frombuffer(blob, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        magic, height, width, channels = _BLOB_HEADER.unpack_from(blob)
+        if magic != _BLOB_MAGIC:
+            raise ValueError(f"Unknown snapshot blob format: {bytes(blob[:len(_BLOB_MAGIC)])!r}")
+        pixels = zstd.ZstdDecompressor().decompress(blob[_BLOB_HEADER.size:])
+        return np.frombuffer(pixels, dtype=np.uint8).reshape(height, width, channels)
+
     def _save_screenshot_diff(self, new_img):
-        if self.base_image is None:
-            self.base_image = new_img
+        if self.base_image is None or self._diff_frame_shape != new_img.shape:
+            self._reset_diff_buffers(new_img)
             return
 
-        diff = cv2.absdiff(self.base_image, new_img)
-        gray_diff = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
-        _, diff_thresh = cv2.threshold(gray_diff, 30, 255, cv2.THRESH_BINARY)
-        x, y, w, h = cv2.boundingRect(diff_thresh)
+        # Locate the change on frames downscaled by _DIFF_SCALE, then crop the
+        # full-resolution frame.
+        cv2.resize(new_img, self._new_small.shape[1::-1], dst=self._new_small, interpolation=cv2.INTER_AREA)
+        x, y, w, h, changed = self._diff_bbox(self.base_image, self._new_small)
+        if w == 0 or h == 0:
+            return
 
-        ocr_results = self.ocr.extract_text(new_img)
-        ocr_text_json = [
-            {
-                "text": result['text'],
-                "rect": {
-                    "x": result['rect'][0],
-                    "y": result['rect'][1],
-                    "width": result['rect'][2] - result['rect'][0],
-                    "height": result['rect'][3] - result['rect'][1]
-                }
-            } for result in ocr_results
-        ]
+        # Skip tiny or sparse changes (caret blinks, clock ticks), but absorb
+        # them into the base; otherwise a change that never reverts, like a
+        # clock, would stay in every later box and dilute real edits below the
+        # density gate. The area is that of the change itself, before padding.
+        if changed / (w * h) < self._min_diff_density or w * h * _DIFF_SCALE ** 2 < self._min_diff_area:
+            self.base_image, self._new_small = self._new_small, self.base_image
+            return
+        x, y, w, h = self._scale_bbox(x, y, w, h)
 
+        # When the OCR worker is saturated the frame is skipped without moving
+        # the base image, so the next diff still covers this change.
+        if not self._ocr_slots.acquire(blocking=False):
+            return
+
+        timestamp = time.time_ns()
         user_inputs = self._save_user_input()
-        user_input_json = json.dumps(user_inputs)
-
-        if w > 0 and h > 0:
-            cropped_diff = new_img[y:y + h, x:x + w]
-            _, compressed_diff = cv2.imencode(".png", cropped_diff)
-
-            conn = self.get_thread_safe_connection()
-            cursor = conn.cursor()
-            timestamp = datetime.now().isoformat()
-            cursor.execute(
-                "INSERT INTO snapshots (timestamp, type, data, position, text, user_input) VALUES (?, ?, ?, ?, ?, ?)",
-                (
-                    timestamp,
-                    "desktop_screenshot",
-                    compressed_diff.tobytes(),
-                    f'{{"x": {x}, "y": {y}, "width": {w}, "height": {h}}}',
-                    json.dumps(ocr_text_json),
-                    user_input_json
-                )
-            )
-            conn.commit()
-            conn.close()
+        cropped_diff = new_img[y:y + h, x:x + w].copy()
+        future = self._ocr_executor.submit(
+            self._process_screenshot_diff, cropped_diff, timestamp, user_inputs, x, y, w, h,
+            self._frame_origins
+        )
+        future.add_done_callback(lambda _: self._ocr_slots.release())
+
+        # The downscaled frame becomes the new base; the old base buffer is
+        # reused for the next downscale.
+        self.base_image, self._new_small = self._new_small, self.base_image
+
+    @staticmethod
+    def _canvas_to_screen(origins, x, y):
+        # Map a point on the capture canvas to screen coordinates through the
+        # band (monitor or capture region) that contains it.
+        for band_y, band_height, left, top in origins:
+            if y < band_y + band_height:
+                break
+        return x + left, y - band_y + top
+
+    def _process_screenshot_diff(self, cropped_diff, timestamp, user_inputs, x, y, w, h, origins):
+        try:
+            # OCR runs on the changed region only; rects are shifted back to
+            # canvas coordinates.
+            ocr_results = self.ocr.extract_text(cropped_diff)
+            texts = [result['text'] for result in ocr_results]
+            # (x_min, y_min, x_max, y_max) -> (x, y, width, height) for all results at once
+            rects = np.asarray([result['rect'] for result in ocr_results], dtype=np.int32).reshape(-1, 4)
+            rects[:, 2:] -= rects[:, :2]
+            rects[:, :2] += (x, y)
+            ocr_text_json = [
+                {
+                    "text": text,
+                    "rect": {"x": rx, "y": ry, "width": rw, "height": rh}
+                } for text, (rx, ry, rw, rh) in zip(texts, rects.tolist())
+            ]
 
-        self.base_image = new_img
+            # Index the latest OCR result by lowercased text for click_button,
+            # with rects moved from the canvas to screen coordinates.
+            text_index = {}
+            for entry in ocr_text_json:
+                rect = entry["rect"]
+                screen_x, screen_y = self._canvas_to_screen(origins, rect["x"], rect["y"])
+                text_index[entry["text"].strip().lower()] = {
+                    "x": screen_x, "y": screen_y, "width": rect["width"], "height": rect["height"]
+                }
+            with self.lock:
+                self._last_ocr = (time.monotonic(), text_index)
+
+            self._write_queue.put((
+                timestamp,
+                "desktop_screenshot",
+                self._encode_snapshot_blob(cropped_diff),
+                x,
+                y,
+                w,
+                h,
+                ocr_text_json,
+                user_inputs
+            ))
+        except Exception as e:
+            BBLogger.log(f"Error processing screenshot diff: {e}")
 
     @classmethod
     def get_desktop_singleton(cls):
-        with cls._lock:
-            if cls._instance is None:
-                cls._instance = cls()
+        # Double-checked locking: once the instance exists, callers never touch the lock.
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls()
         return cls._instance
 
     def get_screen_coordinates(self):
@@ -185,323 +874,120 @@ class Desktop:
         return screen_info
 
     def get_open_windows(self):
-        def _get_linux_windows():
-            try:
-                output = subprocess.check_output(["wmctrl", "-l"]).decode("utf-8").strip().split("\n")
-                windows = [{"id": line.split()[0], "title": line.split(None, 3)[-1]} for line in output]
-                return windows
-            except subprocess.CalledProcessError:
-                return []
-
-        def _get_window_windows():
-            if self.system != "Windows":
-                raise EnvironmentError("This method is only available on Windows.")
-
-            windows = []
-            for win in gw.getAllWindows():
-                windows.append({
-                    "title": win.title,
-                    "left": win.left,
-                    "top": win.top,
-                    "width": win.width,
-                    "height": win.height,
-                })
-            return windows
-
-        def _get_darwin_windows():
-            if self.system != "Darwin":
-                raise EnvironmentError("This method is only available on macOS.")
-
-            window_list = CGWindowListCopyWindowInfo(kCGWindowListOptionOnScreenOnly, kCGNullWindowID)
-            windows = []
-            for window in window_list:
-                title = window.get("kCGWindowName", "Unknown")
-                bounds = window.get("kCGWindowBounds", {})
-                x = int(bounds.get("X", 0))
-                y = int(bounds.get("Y", 0))
-                width = int(bounds.get("Width", 0))
-                height = int(bounds.get("Height", 0))
-                windows.append({
-                    "title": title,
-                    "left": x,
-                    "top": y,
-                    "width": width,
-                    "height": height,
-                })
-            return windows
-
-        if self.system == "Linux":
-            return _get_linux_windows()
-        elif self.system == "Windows":
-            return _get_window_windows()
-        elif self.system == "Darwin":
-            return _get_darwin_windows()
-        else:
-            raise NotImplementedError("This method is only implemented for Windows and macOS.")
+        return self._platform_impl["open_windows"]()
 
     def get_focused_window(self):
-        def _get_linux_focused_window():
-            try:
-                window_id = subprocess.check_output(["xprop", "-root", "_NET_ACTIVE_WINDOW"]).decode().strip()
-                window_id = window_id.split()[-1]
-
-                window_info = subprocess.check_output(["xwininfo", "-id", window_id]).decode().splitlines()
-                window_name = ""
-                for line in window_info:
-                    if "xwininfo" in line and "-name" in line:
-                        window_name = line.split('"', 1)[-1].strip().strip('"')
-                        break
-                return {"title": window_name, "id": window_id}
-            except Exception as e:
-                BBLogger.log(f"Error retrieving focused window on Linux: {e}")
-                return None
-
-        def _get_windows_focused_window():
-            try:
-                active_window = gw.getActiveWindow()
-                if active_window:
-                    return {
-                        "title": active_window.title,
-                        "left": active_window.left,
-                        "top": active_window.top,
-                        "width": active_window.width,
-                        "height": active_window.height,
-                    }
-                else:
-                    BBLogger.log("No active window found.")
-                    return None
-            except Exception as e:
-                BBLogger.log(f"Error retrieving focused window on Windows: {e}")
-                return None
-
-        def _get_darwin_focused_window():
-            try:
-                window_list = CGWindowListCopyWindowInfo(
-                    kCGWindowListOptionOnScreenAbove, CGMainDisplayID()
-                )
-                for window in window_list:
-                    if window.get("kCGWindowIsOnscreen") and window.get("kCGWindowName"):
-                        bounds = window["kCGWindowBounds"]
-                        return {
-                            "title": window.get("kCGWindowName"),
-                            "left": int(bounds["X"]),
-                            "top": int(bounds["Y"]),
-                            "width": int(bounds["Width"]),
-                            "height": int(bounds["Height"]),
-                        }
-                BBLogger.log("No focused window found.")
-                return None
-            except Exception as e:
-                BBLogger.log(f"Error retrieving focused window on macOS: {e}")
-                return None
-
-        if self.system == "Linux":
-            return _get_linux_focused_window()
-        elif self.system == "Windows":
-            return _get_windows_focused_window()
-        elif self.system == "Darwin":
-            return _get_darwin_focused_window()
-        else:
-            raise NotImplementedError("This method is only implemented for Linux, Windows, and macOS.")
+        return self._platform_impl["focused_window"]()
 
     def take_screenshot_from_window(self, name):
-        def _take_screenshot_linux(name):
-            try:
-                window_id = None
-                output = subprocess.check_output(["wmctrl", "-l"]).decode("utf-8").strip().split("\n")
-                for line in output:
-                    if name in line:
-                        window_id = line.split()[0]
-                        break
-
-                if not window_id:
-                    BBLogger.log(f"Window '{name}' not found.")
-                    return None
-
-                output = subprocess.check_output(["xwininfo", "-id", window_id]).decode("utf-8")
-                x, y, width, height = None, None, None, None
-                for line in output.splitlines():
-                    if "Absolute upper-left X" in line:
-                        x = int(line.split(":")[1].strip())
-                    elif "Absolute upper-left Y" in line:
-                        y = int(line.split(":")[1].strip())
-                    elif "Width" in line:
-                        width = int(line.split(":")[1].strip())
-                    elif "Height" in line:
-                        height = int(line.split(":")[1].strip())
-
-                if x is None or y is None or width is None or height is None:
-                    BBLogger.log("Unable to retrieve window geometry.")
-                    return None
-
-                bbox = (x, y, x + width, y + height)
-                screenshot = ImageGrab.grab(bbox)
-                screenshot.save(f"{name}_screenshot.png")
-                BBLogger.log(f"Screenshot saved as {name}_screenshot.png")
-                return screenshot
-            except Exception as e:
-                BBLogger.log(f"Error capturing screenshot on Linux: {e}")
-                return None
-
-        def _take_screenshot_windows(name):
-            try:
-                window = gw.getWindowsWithTitle(name)
-                if not window:
-                    BBLogger.log(f"Window '{name}' not found.")
-                    return None
-                window = window[0]
-                bbox = (window.left, window.top, window.right, window.bottom)
-                screenshot = ImageGrab.grab(bbox)
-                screenshot.save(f"{name}_screenshot.png")
-                BBLogger.log(f"Screenshot saved as {name}_screenshot.png")
-                return screenshot
-            except Exception as e:
-                BBLogger.log(f"Error capturing screenshot on Windows: {e}")
-                return None
-
-        def _take_screenshot_macos(name):
-            try:
-                window_info_list = CGWindowListCopyWindowInfo(
-                    kCGWindowListOptionOnScreenOnly, kCGNullWindowID
-                )
-                for window in window_info_list:
-                    if window.get("kCGWindowName") == name:
-                        bounds = window["kCGWindowBounds"]
-                        x, y = int(bounds["X"]), int(bounds["Y"])
-                        width, height = int(bounds["Width"]), int(bounds["Height"])
-
-                        image = Quartz.CGWindowListCreateImage(
-                            (x, y, width, height),
-                            Quartz.kCGWindowListOptionOnScreenOnly,
-                            Quartz.kCGNullWindowID,
-                            Quartz.kCGWindowImageDefault
-                        )
-
-                        if image:
-                            data = Quartz.CGDataProviderCopyData(Quartz.CGImageGetDataProvider(image))
-                            pil_image = Image.open(io.BytesIO(data))
-                            pil_image.save(f"{name}_screenshot.png")
-                            BBLogger.log(f"Screenshot saved as {name}_screenshot.png")
-                            return pil_image
-                        break
-                else:
-                    BBLogger.log(f"Window '{name}' not found.")
-                    return None
-            except Exception as e:
-                BBLogger.log(f"Error capturing screenshot on macOS: {e}")
-                return None
-
-        if self.system == "Linux":
-            return _take_screenshot_linux(name)
-        elif self.system == "Windows":
-            return _take_screenshot_windows(name)
-        elif self.system == "Darwin":
-            return _take_screenshot_macos(name)
-        else:
-            raise NotImplementedError("This method is only implemented for Linux, Windows, and macOS.")
+        return self._platform_impl["screenshot_from_window"](self, name)
+
+    def _grab_window_region(self, name, left, top, width, height):
+        with self._sct_lock:
+            grab = self._get_sct().grab({"left": left, "top": top, "width": width, "height": height})
+
+        # Encode the PNG from a view of the BGRA buffer, and build the returned
+        # PIL image straight from the raw bytes in one conversion pass.
+        bgra = np.frombuffer(grab.raw, dtype=np.uint8).reshape(grab.height, grab.width, 4)
+        _, png = cv2.imencode(".png", bgra[..., :3])
+        with open(f"{name}_screenshot.png", "wb") as f:
+            f.write(png.tobytes())
+        BBLogger.log(f"Screenshot saved as {name}_screenshot.png")
+        return Image.frombytes("RGB", (grab.width, grab.height), grab.raw, "raw", "BGRX")
+
+    def _get_sct(self):
+        # Caller holds self._sct_lock.
+        sct = getattr(self._sct_local, "sct", None)
+        if sct is None:
+            sct = self._sct_local.sct = mss()
+            self._sct_local.monitors_at = time.monotonic()
+        return sct
+
+    def _get_monitors(self, sct):
+        # Caller holds self._sct_lock. Clearing mss's private cache makes the
+        # next .monitors access query the platform again.
+        now = time.monotonic()
+        if now - self._sct_local.monitors_at >= _MONITOR_REFRESH_INTERVAL:
+            sct._monitors.clear()
+            self._sct_local.monitors_at = now
+        return sct.monitors
 
     def take_snapshot(self):
         return self.take_fullscreen_screenshot()
 
     def take_fullscreen_screenshot(self):
-        with mss() as sct:
-            screenshots = [np.array(sct.grab(monitor)) for monitor in sct.monitors[1:]]
-            combined_screenshot = cv2.vconcat(screenshots) if len(screenshots) > 1 else screenshots[0]
-
-            if combined_screenshot.shape[2] == 4:
-                combined_screenshot = cv2.cvtColor(combined_screenshot, cv2.COLOR_BGRA2BGR)
-
-            if self.base_image is None:
-                self.base_image = combined_screenshot
+        # The canvas is shared between threads, so concurrent captures are
+        # serialized.
+        with self._sct_lock:
+            sct = self._get_sct()
+            # Wrap each BGRA grab without copying it, then drop the alpha channel
+            # straight into its band of a persistent BGR canvas. Monitors are
+            # stacked vertically; narrower monitors leave the right edge black.
+            # An optional capture_region ({'left', 'top', 'width', 'height'})
+            # restricts the capture to that rectangle instead of every monitor.
+            region = BBConfig.get('capture_region')
+            frames = []
+            origins = []
+            band_y = 0
+            try:
+                for monitor in ([region] if region else self._get_monitors(sct)[1:]):
+                    grab = sct.grab(monitor)
+                    frames.append(np.frombuffer(grab.raw, dtype=np.uint8).reshape(grab.height, grab.width, 4))
+                    origins.append((band_y, grab.height, monitor['left'], monitor['top']))
+                    band_y += grab.height
+            except ScreenShotError:
+                # Most likely a monitor disappeared; re-query the geometry next time.
+                sct._monitors.clear()
+                raise
+            self._frame_origins = tuple(origins)
+
+            layout = tuple(frame.shape[:2] for frame in frames)
+            if self._frame_bgr is None or self._frame_layout != layout:
+                total_height = sum(height for height, _ in layout)
+                max_width = max(width for _, width in layout)
+                self._frame_bgr = np.zeros((total_height, max_width, 3), dtype=np.uint8)
+                self._frame_layout = layout
+
+            y0 = 0
+            for frame in frames:
+                height, width = frame.shape[:2]
+                cv2.mixChannels([frame], [self._frame_bgr[y0:y0 + height, :width]], [0, 0, 1, 1, 2, 2])
+                y0 += height
+
+            combined_screenshot = self._frame_bgr
 
             if BBConfig.get('write_screenshots_to_files'):
-                timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+                # Microseconds keep back-to-back captures from overwriting each other
+                timestamp = datetime.now().strftime('%Y%m%d%H%M%S_%f')
                 snapshot_dir = BBConfig.get('snapshot_images')
                 os.makedirs(snapshot_dir, exist_ok=True)
-                snapshot_path = os.path.join(snapshot_dir, f'snapshot_{timestamp}.png')
-                cv2.imwrite(snapshot_path, combined_screenshot)
+                if BBConfig.get('write_snapshots_as_npy'):
+                    # Raw array dump: no encoder pass, for callers that only need the pixels back
+                    np.save(os.path.join(snapshot_dir, f'snapshot_{timestamp}.npy'), combined_screenshot)
+                else:
+                    cv2.imwrite(os.path.join(snapshot_dir, f'snapshot_{timestamp}.png'), combined_screenshot)
 
             if BBConfig.get('snapshots_database_enabled'):
                 self._save_screenshot_diff(new_img=combined_screenshot)
 
-            return combined_screenshot
+            # The canvas is overwritten by the next capture, so callers get their own copy.
+            return combined_screenshot.copy()
+
+    def take_fullscreen_screenshot_raw(self):
+        # Return the untouched mss ScreenShot of the whole virtual screen, for
+        # callers that hand the BGRA buffer straight to PIL. Unlike
+        # take_fullscreen_screenshot, this skips the BGR canvas copy and does
+        # not write files or update the diff database. capture_region applies here too.
+        # The geometry differs with several monitors: this grab is their bounding
+        # box in the real screen layout, while take_fullscreen_screenshot stacks
+        # them vertically. With one monitor or a capture_region the two match.
+        region = BBConfig.get('capture_region')
+        with self._sct_lock:
+            sct = self._get_sct()
+            return sct.grab(region or self._get_monitors(sct)[0])
 
     def get_window_coordinates(self):
-        def _get_linux_window_coordinates():
-            try:
-                windows = []
-                output = subprocess.check_output(["wmctrl", "-l"]).decode("utf-8").strip().split("\n")
-                for line in output:
-                    window_id = line.split()[0]
-                    window_name = line.split(None, 3)[-1]
-                    win_output = subprocess.check_output(["xwininfo", "-id", window_id]).decode("utf-8")
-                    x, y, width, height = None, None, None, None
-                    for detail in win_output.splitlines():
-                        if "Absolute upper-left X" in detail:
-                            x = int(detail.split(":")[1].strip())
-                        elif "Absolute upper-left Y" in detail:
-                            y = int(detail.split(":")[1].strip())
-                        elif "Width" in detail:
-                            width = int(detail.split(":")[1].strip())
-                        elif "Height" in detail:
-                            height = int(detail.split(":")[1].strip())
-                    windows.append({
-                        "title": window_name,
-                        "left": x,
-                        "top": y,
-                        "width": width,
-                        "height": height
-                    })
-                return windows
-            except subprocess.CalledProcessError as e:
-                BBLogger.log(f"Error retrieving window coordinates on Linux: {e}")
-                return []
-
-        def _get_windows_window_coordinates():
-            windows = []
-            for win in gw.getAllWindows():
-                windows.append({
-                    "title": win.title,
-                    "left": win.left,
-                    "top": win.top,
-                    "width": win.width,
-                    "height": win.height
-                })
-            return windows
-
-        def _get_darwin_window_coordinates():
-            try:
-                windows = []
-                window_list = CGWindowListCopyWindowInfo(
-                    kCGWindowListOptionOnScreenOnly, kCGNullWindowID
-                )
-                for window in window_list:
-                    title = window.get("kCGWindowName", "Unknown")
-                    bounds = window.get("kCGWindowBounds", {})
-                    x = int(bounds.get("X", 0))
-                    y = int(bounds.get("Y", 0))
-                    width = int(bounds.get("Width", 0))
-                    height = int(bounds.get("Height", 0))
-                    windows.append({
-                        "title": title,
-                        "left": x,
-                        "top": y,
-                        "width": width,
-                        "height": height
-                    })
-                return windows
-            except Exception as e:
-                BBLogger.log(f"Error retrieving window coordinates on macOS: {e}")
-                return []
-
-        if self.system == "Linux":
-            return _get_linux_window_coordinates()
-        elif self.system == "Windows":
-            return _get_windows_window_coordinates()
-        elif self.system == "Darwin":
-            return _get_darwin_window_coordinates()
-        else:
-            raise NotImplementedError("This method is only implemented for Linux, Windows, and macOS.")
+        return self._platform_impl["window_coordinates"]()
 
     def move_mouse_to(self, coordinate):
         if isinstance(coordinate, tuple) and len(coordinate) == 2:
@@ -518,25 +1004,57 @@ class Desktop:
     def click_button(self, button_text):
         try:
             BBLogger.log(f"Searching for button with text: '{button_text}'")
-            screenshot = pyautogui.screenshot()
-            ocr_data = pytesseract.image_to_data(screenshot, output_type=pytesseract.Output.DICT)
-            for i, text in enumerate(ocr_data['text']):
-                if text.strip().lower() == button_text.lower():
-                    x = ocr_data['left'][i]
-                    y = ocr_data['top'][i]
-                    width = ocr_data['width'][i]
-                    height = ocr_data['height'][i]
-                    center_x = x + width // 2
-                    center_y = y + height // 2
-                    pyautogui.click(center_x, center_y)
-                    BBLogger.log(f"Button '{button_text}' clicked at location: ({center_x}, {center_y})")
-                    return True
-            BBLogger.log(f"Button '{button_text}' not found on screen.")
-            return False
+            rect = self._find_text_in_last_ocr(button_text)
+            if rect is None:
+                rect = self._find_text_in_focused_window(button_text)
+            if rect is None:
+                BBLogger.log(f"Button '{button_text}' not found on screen.")
+                return False
+
+            center_x = rect["x"] + rect["width"] // 2
+            center_y = rect["y"] + rect["height"] // 2
+            pyautogui.click(center_x, center_y)
+            BBLogger.log(f"Button '{button_text}' clicked at location: ({center_x}, {center_y})")
+            return True
         except Exception as e:
             BBLogger.log(f"Error finding button '{button_text}': {e}")
             return False
 
+    def _find_text_in_last_ocr(self, text):
+        with self.lock:
+            last_ocr = self._last_ocr
+        if last_ocr is None:
+            return None
+        timestamp, text_index = last_ocr
+        if time.monotonic() - timestamp > _OCR_CACHE_TTL:
+            return None
+        return text_index.get(text.lower())
+
+    def _find_text_in_focused_window(self, text):
+        # Restrict tesseract to the focused window when its geometry is known,
+        # and fall back to the whole screen otherwise.
+        region = None
+        window = self.get_focused_window()
+        if window and all(key in window for key in ("left", "top", "width", "height")):
+            region = (window["left"], window["top"], window["width"], window["height"])
+
+        screenshot = pyautogui.screenshot(region=region)
+        offset_x, offset_y = (region[0], region[1]) if region else (0, 0)
+        # A single window crop reads well as one block of text (--psm 6); the
+        # whole desktop needs tesseract's default layout analysis.
+        ocr_data = pytesseract.image_to_data(
+            screenshot, config='--psm 6' if region else '', output_type=pytesseract.Output.DICT
+        )
+        for i, word in enumerate(ocr_data['text']):
+            if word.strip().lower() == text.lower():
+                return {
+                    "x": ocr_data['left'][i] + offset_x,
+                    "y": ocr_data['top'][i] + offset_y,
+                    "width": ocr_data['width'][i],
+                    "height": ocr_data['height'][i]
+                }
+        return None
+
 
 
     # ----------------- Snapshot Method Added Below ----------------- #
@@ -11,6 +11,7 @@ setup(
     install_requires=[
         "opencv-python-headless==4.10.0.84",
         "numpy>=1.24.0,<2.0.0",
+        "orjson==3.10.15",
         "PyAutoGUI==0.9.54",
         "pytesseract==0.3.13",
         "mss==9.0.2",
@@ -18,10 +19,17 @@ setup(
         "screeninfo==0.8.1",
         "pynput==1.7.7",
         "PyGetWindow==0.0.9",
+        "zstandard==0.23.0",
     ],
     extras_require={
         "dev": [
             "pytest==8.3.4",
+            "pytest-xdist==3.6.1",
+            "filelock==3.17.0",
+            "simplejpeg==1.8.1",
+        ],
+        "numba": [
+            "numba>=0.60.0",
         ],
     },
     classifiers=[
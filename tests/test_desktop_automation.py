@@ -3,43 +3,187 @@
 import pytest
 import platform
 import os
-import random
+import sys
+import sqlite3
+import itertools
+import tempfile
+import threading
+import collections
+import queue
+import time
+from filelock import FileLock
 from pathlib import Path
 from PIL import Image
-from brainboost_desktop_package.Desktop import Desktop
+from brainboost_desktop_package.Desktop import (
+    Desktop,
+    _DIFF_PAD,
+    _DIFF_SCALE,
+    _DIFF_THRESHOLD,
+    _diff_bbox_kernel,
+    _INPUT_KEYBOARD,
+    _INPUT_MOUSE,
+    _KEY_IDLE_FLUSH_NS,
+    _KEY_REPEAT_WINDOW_NS,
+    _MIN_DIFF_AREA,
+    _MIN_DIFF_DENSITY,
+    _MONITOR_REFRESH_INTERVAL,
+    _OCR_CACHE_TTL,
+    _WMCTRL_RE,
+    _find_wmctrl_window,
+)
 from brainboost_configuration_package.BBConfig import BBConfig
 from datetime import datetime  # Ensure correct import
 import numpy as np
+import simplejpeg
+import zstandard as zstd
+import cv2
+
+# Resolve the platform and its window API once per session instead of per test
+_SYS = platform.system()
+if _SYS == "Windows":
+    import pygetwindow as _gw
+elif _SYS == "Darwin":
+    from Quartz import CGWindowListCopyWindowInfo, kCGWindowListOptionOnScreenOnly, kCGNullWindowID
 
 # Override configurations for testing purposes
 BBConfig.override('snapshots_database_enabled', False)
 BBConfig.override('snapshots_database_path', '')
 BBConfig.override('write_screenshots_to_files', True)  # Added override
-TEST_IMAGES_DIR = Path(__file__).parent / "test_images"
+BBConfig.override('write_snapshots_as_npy', True)  # Dump snapshots as raw .npy instead of encoding PNG
+# The tests only check shapes and modes, which a small corner of the screen satisfies
+BBConfig.override('capture_region', {'left': 0, 'top': 0, 'width': 256, 'height': 256})
+# Under pytest-xdist every worker gets its own image directory, so the cleanup
+# fixture and the snapshot file checks never see another worker's files.
+TEST_IMAGES_DIR = Path(__file__).parent / "test_images" / os.environ.get("PYTEST_XDIST_WORKER", "")
 BBConfig.override('snapshot_images', str(TEST_IMAGES_DIR))  # Ensure snapshot_images points to the test directory
 
+# Resolve the settings the tests read once, after the overrides above
+_SNAPSHOT_DIR = Path(BBConfig.get('snapshot_images'))
+_WRITE_FILES = BBConfig.get('write_screenshots_to_files')
+
+# Keys every screen and window rectangle must carry as ints
+_RECT_KEYS = ("left", "top", "width", "height")
+_RECT_KEY_SET = frozenset(_RECT_KEYS)
+_BOUNDS_KEYS = ("X", "Y", "Width", "Height")
+_BOUNDS_KEY_SET = frozenset(_BOUNDS_KEYS)
+
+# Re-reading saved files only repeats work the tests just did; opt in with
+# BB_TEST_VERIFY_ROUNDTRIP=1 when debugging the writers themselves.
+_VERIFY_ROUNDTRIP = bool(os.environ.get("BB_TEST_VERIFY_ROUNDTRIP"))
+
+# One timestamp per test run plus a counter, so file names never collide
+# even when several tests finish within the same second.
+_RUN_STAMP = datetime.now().strftime('%Y%m%d%H%M%S')
+_counter = itertools.count()
+
+# X11 cannot serve concurrent grabs, so screen captures are serialized across
+# xdist workers; encoding and verification still run in parallel.
+_capture_lock = FileLock(str(Path(tempfile.gettempdir()) / "brainboost_desktop_capture.lock"))
+
+class _SanitizeTable(dict):
+    """str.translate table that maps every code point it does not list to '_'."""
+
+    def __missing__(self, codepoint):
+        return '_'
+
+# ASCII letters and digits survive in file names; everything else becomes '_'
+_SANITIZE = _SanitizeTable({c: chr(c) for c in range(128) if chr(c).isalnum()})
+
+def array_to_image(array):
+    """Wrap a uint8 HxW or HxWx3 array in a PIL image without copying its pixels.
+
+    The array is made C-contiguous once, then Image.frombuffer maps its memory
+    directly instead of Image.fromarray copying it into a fresh PIL buffer.
+    """
+    array = np.ascontiguousarray(array)
+    mode = 'L' if array.ndim == 2 else 'RGB'
+    return Image.frombuffer(mode, (array.shape[1], array.shape[0]), array, 'raw', mode, 0, 1)
+
+def save_test_image(image, path_stem):
+    """Save an ndarray or PIL image as an uncompressed TIFF and return its path.
+
+    Used by tests that only re-open the file to check its size and mode, where
+    PNG deflate would be pure overhead.
+    """
+    if not isinstance(image, Image.Image):
+        image = array_to_image(image)
+    path = Path(f"{path_stem}.tiff")
+    image.save(path, format="TIFF", compression="raw")
+    return path
+
+def _luminance_x256(screenshot):
+    """Return 256 times the BT.601 luminance of a BGR screenshot as uint16.
+
+    Uses the integer weights 77*R + 150*G + 29*B on uint16 temporaries, which
+    stays in integer SIMD lanes instead of going through float.
+    """
+    blue, green, red = (screenshot[..., channel].astype(np.uint16) for channel in range(3))
+    return 77 * red + 150 * green + 29 * blue
+
+def emit_all(shot, stem):
+    """Write the RGB, grayscale and black-and-white variants of a BGR screenshot.
+
+    The luminance is computed once and both the grayscale and the black-and-white
+    image are derived from it, rather than each conversion re-reading the frame;
+    the JPEG encoder still reads the frame separately. Returns a dict mapping
+    'rgb', 'gray' and 'bw' to (path, in-memory image) pairs.
+    """
+    shot = np.ascontiguousarray(shot)
+    height, width = shot.shape[:2]
+    gray = (_luminance_x256(shot) >> 8).astype(np.uint8)
+    bw = Image.frombytes('1', (width, height), np.packbits(gray > 128, axis=1).tobytes())
+    gray_image = array_to_image(gray)
+
+    rgb_path = Path(f"{stem}.jpg")
+    rgb_path.write_bytes(simplejpeg.encode_jpeg(shot, quality=85, colorspace='BGR'))
+    gray_path = Path(f"{stem}_grayscale.png")
+    gray_image.save(gray_path, format="PNG", compress_level=1)
+    bw_path = Path(f"{stem}_black_white.png")
+    bw.save(bw_path, format="PNG", compress_level=1)
+    return {'rgb': (rgb_path, shot), 'gray': (gray_path, gray_image), 'bw': (bw_path, bw)}
+
 # Ensure the test_images directory exists and is clean before tests
 @pytest.fixture(scope="session", autouse=True)
 def setup_test_images_dir():
     """Fixture to set up the test_images directory before tests run."""
     if TEST_IMAGES_DIR.exists():
-        # Remove existing files
-        for file in TEST_IMAGES_DIR.iterdir():
-            if file.is_file():
-                file.unlink()
+        # Remove existing files; os.scandir reads the directory in one batch and
+        # DirEntry.is_file() uses the cached entry type instead of a stat per file
+        with os.scandir(TEST_IMAGES_DIR) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    os.unlink(entry.path)
     else:
         TEST_IMAGES_DIR.mkdir(parents=True, exist_ok=True)
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def desktop_instance():
     """Fixture to create a singleton instance of the Desktop class."""
     return Desktop.get_desktop_singleton()
 
+@pytest.fixture(scope="session")
+def fullscreen_shot():
+    """Fixture that captures the full screen once and shares it across tests."""
+    with _capture_lock:
+        return Desktop.get_desktop_singleton().take_fullscreen_screenshot()
+
+@pytest.fixture(scope="session")
+def fullscreen_outputs(fullscreen_shot):
+    """Fixture that writes the RGB, grayscale and black-and-white files in one pass."""
+    suffix = f"{_RUN_STAMP}_{next(_counter)}"
+    return emit_all(fullscreen_shot, TEST_IMAGES_DIR / f'fullscreen_screenshot_{suffix}')
+
+@pytest.fixture(scope="session")
+def one_open_window(desktop_instance):
+    """Fixture that lists the open windows once and returns the first title."""
+    open_windows = desktop_instance.get_open_windows()
+    assert isinstance(open_windows, list) and len(open_windows) > 0, "There should be at least one open window"
+    window = open_windows[0]
+    return window.get("title") or window.get("kCGWindowName") or "Unknown"
+
 def test_get_open_windows(desktop_instance):
     """Test that get_open_windows returns a list of window titles."""
-    current_system = platform.system()
-    
-    if current_system == "Linux":
+    if _SYS == "Linux":
         open_windows = desktop_instance.get_open_windows()
         assert isinstance(open_windows, list), "Expected a list of window titles"
         if open_windows:
@@ -49,9 +193,7 @@ def test_get_open_windows(desktop_instance):
 
 def test_get_focused_window(desktop_instance):
     """Test that get_focused_window returns a dictionary or None."""
-    current_system = platform.system()
-    
-    if current_system == "Linux":
+    if _SYS == "Linux":
         focused_window = desktop_instance.get_focused_window()
         assert isinstance(focused_window, (dict, type(None))), "Expected focused window to be a dictionary or None"
     else:
@@ -63,36 +205,27 @@ def test_get_screen_coordinates(desktop_instance):
     assert isinstance(screen_coordinates, list), "Expected a list of screen coordinate dictionaries"
     for screen in screen_coordinates:
         assert isinstance(screen, dict), "Each screen coordinate should be a dictionary"
-        assert "left" in screen and isinstance(screen["left"], int), "Each screen should have a 'left' key with an integer value"
-        assert "top" in screen and isinstance(screen["top"], int), "Each screen should have a 'top' key with an integer value"
-        assert "width" in screen and isinstance(screen["width"], int), "Each screen should have a 'width' key with an integer value"
-        assert "height" in screen and isinstance(screen["height"], int), "Each screen should have a 'height' key with an integer value"
+        assert _RECT_KEY_SET.issubset(screen) and all(isinstance(screen[k], int) for k in _RECT_KEYS), \
+            f"Each screen should have integer {_RECT_KEYS} keys, got {screen}"
 
 def test_get_window_coordinates(desktop_instance):
     """Test that get_window_coordinates returns a list of dictionaries with window coordinates."""
-    current_system = platform.system()
-    
-    if current_system == "Linux":
+    if _SYS == "Linux":
         window_coordinates = desktop_instance.get_window_coordinates()
         assert isinstance(window_coordinates, list), "Expected a list of window coordinate dictionaries"
         for window in window_coordinates:
             assert isinstance(window, dict), "Each window coordinate should be a dictionary"
             assert "title" in window and isinstance(window["title"], str), "Each window should have a 'title' key with a string value"
-            assert "left" in window and isinstance(window["left"], int), "Each window should have a 'left' key with an integer value"
-            assert "top" in window and isinstance(window["top"], int), "Each window should have a 'top' key with an integer value"
-            assert "width" in window and isinstance(window["width"], int), "Each window should have a 'width' key with an integer value"
-            assert "height" in window and isinstance(window["height"], int), "Each window should have a 'height' key with an integer value"
+            assert _RECT_KEY_SET.issubset(window) and all(isinstance(window[k], int) for k in _RECT_KEYS), \
+                f"Each window should have integer {_RECT_KEYS} keys, got {window}"
     
-    elif current_system == "Windows":
-        import pygetwindow as gw  # Only import if on Windows
-        windows = gw.getAllTitles()
+    elif _SYS == "Windows":
+        windows = _gw.getAllTitles()
         assert isinstance(windows, list), "Expected a list of window titles"
         if windows:
             assert all(isinstance(title, str) for title in windows), "All window titles should be strings"
     
-    elif current_system == "Darwin":
-        from Quartz import CGWindowListCopyWindowInfo, kCGWindowListOptionOnScreenOnly, kCGNullWindowID
-        
+    elif _SYS == "Darwin":
         window_list = CGWindowListCopyWindowInfo(kCGWindowListOptionOnScreenOnly, kCGNullWindowID)
         assert isinstance(window_list, list), "Expected a list of window dictionaries"
         for window in window_list:
@@ -102,64 +235,93 @@ def test_get_window_coordinates(desktop_instance):
             
             # Check bounds for window coordinates
             bounds = window["kCGWindowBounds"]
-            assert "X" in bounds and isinstance(bounds["X"], int), "Each window should have an 'X' key in bounds with an integer value"
-            assert "Y" in bounds and isinstance(bounds["Y"], int), "Each window should have a 'Y' key in bounds with an integer value"
-            assert "Width" in bounds and isinstance(bounds["Width"], int), "Each window should have a 'Width' key in bounds with an integer value"
-            assert "Height" in bounds and isinstance(bounds["Height"], int), "Each window should have a 'Height' key in bounds with an integer value"
+            assert _BOUNDS_KEY_SET.issubset(bounds) and all(isinstance(bounds[k], int) for k in _BOUNDS_KEYS), \
+                f"Each window should have integer {_BOUNDS_KEYS} keys in bounds, got {bounds}"
     
     else:
         pytest.skip("This test is only implemented for Linux, Windows, and macOS systems.")
 
-def test_take_fullscreen_screenshot(desktop_instance):
+def test_take_fullscreen_screenshot(fullscreen_outputs):
     """
     Test that take_fullscreen_screenshot captures the entire desktop,
     saves the image to tests/test_images, and verifies the image is valid.
     """
-    try:
-        screenshot = desktop_instance.take_fullscreen_screenshot()
-        assert screenshot is not None, "Screenshot should not be None"
+    screenshot_path, screenshot = fullscreen_outputs['rgb']
+    assert screenshot_path.exists(), f"Screenshot file {screenshot_path} should exist"
+    assert screenshot.shape[1] > 0 and screenshot.shape[0] > 0, "Image dimensions should be greater than zero"
+    assert screenshot.ndim == 3 and screenshot.shape[2] == 3, f"Image should have 3 color channels, got shape {screenshot.shape}"
 
-        # Save the screenshot to the test_images directory
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        screenshot_path = TEST_IMAGES_DIR / f'fullscreen_screenshot_{timestamp}.png'
-        Image.fromarray(screenshot).save(screenshot_path)
+def test_take_fullscreen_screenshot_raw(desktop_instance):
+    """
+    Test that take_fullscreen_screenshot_raw returns a grab that PIL can
+    decode straight from the BGRA buffer, without an intermediate ndarray.
+    """
+    try:
+        with _capture_lock:
+            shot = desktop_instance.take_fullscreen_screenshot_raw()
+        assert shot is not None, "Raw screenshot should not be None"
+
+        # One C-level pass from BGRA to RGB, skipping the alpha byte
+        img = Image.frombytes('RGB', shot.size, shot.raw, 'raw', 'BGRX')
+        suffix = f"{_RUN_STAMP}_{next(_counter)}"
+        screenshot_path = save_test_image(img, TEST_IMAGES_DIR / f'fullscreen_raw_screenshot_{suffix}')
         assert screenshot_path.exists(), f"Screenshot file {screenshot_path} should exist"
 
-        # Open the saved image and verify its properties
-        with Image.open(screenshot_path) as img:
-            assert img.width > 0 and img.height > 0, "Image dimensions should be greater than zero"
-            assert img.mode in ["RGB", "BGR"], f"Image mode should be RGB or BGR, got {img.mode}"
+        assert img.width > 0 and img.height > 0, "Image dimensions should be greater than zero"
+        assert img.mode == "RGB", f"Image mode should be RGB, got {img.mode}"
 
     except Exception as e:
-        pytest.fail(f"take_fullscreen_screenshot failed with exception: {e}")
+        pytest.fail(f"take_fullscreen_screenshot_raw failed with exception: {e}")
 
-def test_take_window_screenshot(desktop_instance):
+def test_take_fullscreen_screenshot_from_another_thread(desktop_instance):
+    """
+    Test that the shared Desktop can capture from a thread other than the one
+    that created it.
+    """
+    results = []
+    def capture():
+        try:
+            results.append(desktop_instance.take_fullscreen_screenshot())
+        except Exception as e:
+            results.append(e)
+
+    with _capture_lock:
+        worker = threading.Thread(target=capture)
+        worker.start()
+        worker.join()
+    assert len(results) == 1 and isinstance(results[0], np.ndarray), f"Capture from a worker thread failed: {results}"
+    assert results[0].size > 0, "Screenshot should not be empty"
+
+def test_monitor_geometry_is_requeried_after_refresh_interval(desktop_instance):
+    """Test that the cached mss monitor geometry is dropped once the refresh interval has passed."""
+    with _capture_lock:
+        desktop_instance.take_fullscreen_screenshot_raw()
+        sct = desktop_instance._sct_local.sct
+        cached = sct.monitors[0]
+        assert desktop_instance._get_monitors(sct)[0] is cached, "Geometry should be cached within the interval"
+        desktop_instance._sct_local.monitors_at -= _MONITOR_REFRESH_INTERVAL
+        assert desktop_instance._get_monitors(sct)[0] is not cached, "Geometry should be re-queried after the interval"
+
+def test_take_window_screenshot(desktop_instance, one_open_window):
     """
     Test that take_screenshot_from_window captures a specific window,
     saves the image to tests/test_images, and verifies the image is valid.
     """
-    current_system = platform.system()
     try:
-        open_windows = desktop_instance.get_open_windows()
-        assert isinstance(open_windows, list) and len(open_windows) > 0, "There should be at least one open window"
-
-        # Select a random window
-        random_window = random.choice(open_windows)
-        window_title = random_window.get("title") or random_window.get("kCGWindowName") or "Unknown"
-        screenshot = desktop_instance.take_screenshot_from_window(window_title)
+        window_title = one_open_window
+        with _capture_lock:
+            screenshot = desktop_instance.take_screenshot_from_window(window_title)
         assert screenshot is not None, f"Screenshot for window '{window_title}' should not be None"
 
         # Save the screenshot to the test_images directory
-        sanitized_title = "".join(c if c.isalnum() else "_" for c in window_title)[:50]  # Sanitize filename
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        screenshot_path = TEST_IMAGES_DIR / f'window_screenshot_{sanitized_title}_{timestamp}.png'
-        screenshot.save(screenshot_path)
+        sanitized_title = window_title.translate(_SANITIZE)[:50]  # Sanitize filename
+        suffix = f"{_RUN_STAMP}_{next(_counter)}"
+        screenshot_path = save_test_image(screenshot, TEST_IMAGES_DIR / f'window_screenshot_{sanitized_title}_{suffix}')
         assert screenshot_path.exists(), f"Screenshot file {screenshot_path} should exist"
 
-        # Open the saved image and verify its properties
-        with Image.open(screenshot_path) as img:
-            assert img.width > 0 and img.height > 0, "Image dimensions should be greater than zero"
-            assert img.mode in ["RGB", "BGR"], f"Image mode should be RGB or BGR, got {img.mode}"
+        # Verify the in-memory image rather than decoding the file again
+        assert screenshot.width > 0 and screenshot.height > 0, "Image dimensions should be greater than zero"
+        assert screenshot.mode in ["RGB", "BGR"], f"Image mode should be RGB or BGR, got {screenshot.mode}"
 
     except Exception as e:
         pytest.fail(f"take_screenshot_from_window failed with exception: {e}")
@@ -169,19 +331,21 @@ def test_snapshot_saves_image_correctly(desktop_instance):
     Test that the take_snapshot method captures the desktop and saves the snapshot correctly.
     """
     try:
-        snapshot = desktop_instance.take_snapshot()
+        with _capture_lock:
+            snapshot = desktop_instance.take_snapshot()
         assert snapshot is not None, "Snapshot should not be None"
 
         # If write_screenshots_to_files is enabled, verify the file is saved
-        if BBConfig.get('write_screenshots_to_files'):
+        if _WRITE_FILES:
             # List files before taking the snapshot
-            before_files = set(TEST_IMAGES_DIR.glob('snapshot_*.png'))
+            before_files = set(_SNAPSHOT_DIR.glob('snapshot_*.npy'))
 
             # Take the snapshot
-            snapshot = desktop_instance.take_snapshot()
+            with _capture_lock:
+                snapshot = desktop_instance.take_snapshot()
 
             # List files after taking the snapshot
-            after_files = set(TEST_IMAGES_DIR.glob('snapshot_*.png'))
+            after_files = set(_SNAPSHOT_DIR.glob('snapshot_*.npy'))
 
             # Identify the new file
             new_files = after_files - before_files
@@ -189,65 +353,42 @@ def test_snapshot_saves_image_correctly(desktop_instance):
             snapshot_path = new_files.pop()
             assert snapshot_path.exists(), f"Snapshot file {snapshot_path} should exist"
 
-            # Open the saved image and verify its properties
-            with Image.open(snapshot_path) as img:
-                assert img.width > 0 and img.height > 0, "Image dimensions should be greater than zero"
-                assert img.mode in ["RGB", "BGR"], f"Image mode should be RGB or BGR, got {img.mode}"
+            # Map the saved array and verify its properties without reading the pixels
+            if _VERIFY_ROUNDTRIP:
+                saved = np.load(snapshot_path, mmap_mode='r')
+                assert saved.shape[1] > 0 and saved.shape[0] > 0, "Image dimensions should be greater than zero"
+                assert saved.ndim == 3 and saved.shape[2] == 3, f"Image should have 3 color channels, got shape {saved.shape}"
+            else:
+                assert snapshot.shape[1] > 0 and snapshot.shape[0] > 0, "Image dimensions should be greater than zero"
 
     except Exception as e:
         pytest.fail(f"take_snapshot failed with exception: {e}")
 
-def test_grayscale_image_capture(desktop_instance):
+def test_grayscale_image_capture(fullscreen_outputs):
     """
     Test that a captured screenshot can be converted to grayscale correctly.
     """
-    try:
-        screenshot = desktop_instance.take_fullscreen_screenshot()
-        assert screenshot is not None, "Screenshot should not be None"
-
-        # Convert to grayscale
-        grayscale_image = Image.fromarray(screenshot).convert('L')  # 'L' mode is for (8-bit pixels, black and white)
-        
-        # Save the grayscale image
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        grayscale_path = TEST_IMAGES_DIR / f'grayscale_screenshot_{timestamp}.png'
-        grayscale_image.save(grayscale_path)
-        assert grayscale_path.exists(), f"Grayscale screenshot file {grayscale_path} should exist"
-
-        # Verify that the image is indeed grayscale
-        with Image.open(grayscale_path) as img:
-            assert img.mode == 'L', f"Image mode should be 'L' for grayscale, got {img.mode}"
+    grayscale_path, grayscale_image = fullscreen_outputs['gray']
+    assert grayscale_path.exists(), f"Grayscale screenshot file {grayscale_path} should exist"
+    assert grayscale_image.size[0] > 0 and grayscale_image.size[1] > 0, "Image dimensions should be greater than zero"
+    assert grayscale_image.mode == 'L', f"Image mode should be 'L' for grayscale, got {grayscale_image.mode}"
 
-    except Exception as e:
-        pytest.fail(f"Grayscale image capture failed with exception: {e}")
-
-def test_black_and_white_image_capture(desktop_instance):
+def test_black_and_white_image_capture(fullscreen_outputs):
     """
     Test that a captured screenshot can be converted to black and white correctly.
     """
-    try:
-        screenshot = desktop_instance.take_fullscreen_screenshot()
-        assert screenshot is not None, "Screenshot should not be None"
-
-        # Convert to black and white using a threshold
-        img = Image.fromarray(screenshot).convert('L')
-        threshold = 128
-        bw_image = img.point(lambda x: 255 if x > threshold else 0, '1')  # '1' mode is for 1-bit pixels, black and white
-
-        # Save the black and white image
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        bw_path = TEST_IMAGES_DIR / f'black_white_screenshot_{timestamp}.png'
-        bw_image.save(bw_path)
-        assert bw_path.exists(), f"Black and white screenshot file {bw_path} should exist"
-
-        # Verify that the image is indeed black and white
-        with Image.open(bw_path) as img:
-            assert img.mode == '1', f"Image mode should be '1' for black and white, got {img.mode}"
-
-    except Exception as e:
-        pytest.fail(f"Black and white image capture failed with exception: {e}")
-
+    bw_path, bw_image = fullscreen_outputs['bw']
+    assert bw_path.exists(), f"Black and white screenshot file {bw_path} should exist"
+    assert bw_image.mode == '1', f"Image mode should be '1' for black and white, got {bw_image.mode}"
 
+def test_emit_all_outputs_match(fullscreen_outputs):
+    """
+    Test that the three variants written in one pass describe the same frame.
+    """
+    screenshot = fullscreen_outputs['rgb'][1]
+    size = (screenshot.shape[1], screenshot.shape[0])
+    assert fullscreen_outputs['gray'][1].size == size, "Grayscale image should match the screenshot dimensions"
+    assert fullscreen_outputs['bw'][1].size == size, "Black and white image should match the screenshot dimensions"
 
 def test_snapshot_return_value(desktop_instance):
     """
@@ -259,7 +400,8 @@ def test_snapshot_return_value(desktop_instance):
     """
     try:
         # Call the snapshot method
-        screenshot, texts_with_rects = desktop_instance.snapshot()
+        with _capture_lock:
+            screenshot, texts_with_rects = desktop_instance.snapshot()
         
         # Verify that the screenshot is a NumPy array
         assert isinstance(screenshot, np.ndarray), "Snapshot image should be a NumPy array"
@@ -290,3 +432,346 @@ def test_snapshot_return_value(desktop_instance):
 
     except Exception as e:
         pytest.fail(f"snapshot method failed with exception: {e}")
+
+
+# ----------------- Display-free tests of the snapshot pipeline ----------------- #
+
+def _bare_desktop(**attrs):
+    """Return a Desktop with only the given attributes, bypassing __init__ (no display or mss)."""
+    desktop = object.__new__(Desktop)
+    desktop.__dict__.update(attrs)
+    return desktop
+
+@pytest.fixture
+def snapshot_db_desktop():
+    """Fixture that gives a bare Desktop with its database writer running on an in-memory database."""
+    BBConfig.override('snapshots_database_enabled', True)
+    BBConfig.override('snapshots_database_path', ':memory:')
+    try:
+        desktop = _bare_desktop(lock=threading.Lock())
+        desktop.init_database()
+    finally:
+        BBConfig.override('snapshots_database_enabled', False)
+        BBConfig.override('snapshots_database_path', '')
+    yield desktop
+    _stop_writer(desktop)
+    desktop.conn.close()
+
+def _stop_writer(desktop):
+    """Post the shutdown sentinel and wait for the writer thread to drain and exit."""
+    if desktop._db_writer_thread.is_alive():
+        desktop._write_queue.put(None)
+        desktop._db_writer_thread.join(timeout=5)
+    assert not desktop._db_writer_thread.is_alive(), "Writer thread should stop on the sentinel"
+
+def _queued_row(ts_ns, ocr_results=()):
+    """Return a snapshot row as _process_screenshot_diff queues it."""
+    return (ts_ns, "desktop_screenshot", b"blob", 1, 2, 3, 4, list(ocr_results), [])
+
+def _snapshot_count(desktop):
+    return desktop.conn.execute("SELECT COUNT(*) FROM snapshots").fetchone()[0]
+
+def test_db_writer_commits_every_queued_row(snapshot_db_desktop):
+    """Test that the writer commits rows spanning several batches before honouring the sentinel."""
+    desktop = snapshot_db_desktop
+    for ts_ns in range(150):
+        desktop._write_queue.put(_queued_row(ts_ns))
+    _stop_writer(desktop)
+    assert _snapshot_count(desktop) == 150, "Every queued row should be committed"
+    stored = [row[0] for row in desktop.conn.execute("SELECT ts_ns FROM snapshots ORDER BY id")]
+    assert stored == list(range(150)), "Rows should be committed in queue order"
+
+def test_write_rows_rolls_back_a_failed_batch(snapshot_db_desktop):
+    """Test that a batch with a bad row is rolled back as a whole and later batches still commit."""
+    desktop = snapshot_db_desktop
+    _stop_writer(desktop)
+    good = (1, "desktop_screenshot", b"blob", 1, 2, 3, 4, "[]", "[]")
+    desktop._write_rows([good, good[:-1]])  # the second row is missing a column
+    assert not desktop.conn.in_transaction, "A failed batch should not leave a transaction open"
+    assert _snapshot_count(desktop) == 0, "A failed batch should be rolled back entirely"
+    desktop._write_rows([good])
+    assert _snapshot_count(desktop) == 1, "The next batch should commit normally"
+
+def test_snapshot_blob_roundtrip():
+    """Test that a snapshot blob decodes back to the original pixels and shape."""
+    desktop = _bare_desktop(_zctx=zstd.ZstdCompressor(level=3))
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, size=(9, 22, 3), dtype=np.uint8)[:, ::2]  # non-contiguous view
+    decoded = Desktop.decode_snapshot_blob(desktop._encode_snapshot_blob(image))
+    assert decoded.shape == image.shape, f"Expected shape {image.shape}, got {decoded.shape}"
+    assert np.array_equal(decoded, image), "Decoded pixels should match the original image"
+
+def test_decode_snapshot_blob_reads_legacy_png_rows():
+    """Test that PNG blobs written by older versions still decode."""
+    image = np.random.default_rng(1).integers(0, 256, size=(6, 5, 3), dtype=np.uint8)
+    _, png = cv2.imencode(".png", image)
+    assert np.array_equal(Desktop.decode_snapshot_blob(png.tobytes()), image), \
+        "Legacy PNG blobs should decode to the original pixels"
+    with pytest.raises(ValueError):
+        Desktop.decode_snapshot_blob(b"\x00" * 16)
+
+class _FixedOcr:
+    """OCR stand-in that returns fixed results and records the images it was given."""
+
+    def __init__(self, results):
+        self.results = results
+        self.images = []
+
+    def extract_text(self, image):
+        self.images.append(image)
+        return self.results
+
+def _ocr_desktop(results):
+    """Return a bare Desktop that can run _process_screenshot_diff with a fixed OCR result."""
+    return _bare_desktop(ocr=_FixedOcr(results), lock=threading.Lock(), _write_queue=queue.Queue(),
+                         _zctx=zstd.ZstdCompressor(level=3), _last_ocr=None)
+
+def test_process_screenshot_diff_shifts_rects_by_crop_offset():
+    """Test that OCR runs on the crop only and its rects are stored in canvas coordinates."""
+    desktop = _ocr_desktop([{"text": "OK", "rect": (2, 3, 12, 8)}, {"text": "Cancel", "rect": (0, 0, 4, 4)}])
+    crop = np.zeros((20, 30, 3), dtype=np.uint8)
+    desktop._process_screenshot_diff(crop, 123, [], 100, 50, 30, 20, ((0, 1080, 0, 0),))
+
+    assert desktop.ocr.images == [crop], "OCR should run on the cropped diff only"
+    ts_ns, _, blob, x, y, w, h, ocr_text_json, _ = desktop._write_queue.get_nowait()
+    assert (ts_ns, x, y, w, h) == (123, 100, 50, 30, 20), "The row should carry the crop position"
+    assert ocr_text_json == [
+        {"text": "OK", "rect": {"x": 102, "y": 53, "width": 10, "height": 5}},
+        {"text": "Cancel", "rect": {"x": 100, "y": 50, "width": 4, "height": 4}},
+    ], f"Unexpected OCR rects {ocr_text_json}"
+    assert np.array_equal(Desktop.decode_snapshot_blob(blob), crop), "The stored blob should hold the crop"
+
+def test_canvas_to_screen_uses_band_origin():
+    """Test that canvas points map through the monitor band that contains them."""
+    origins = ((0, 1080, 0, 0), (1080, 1080, 1920, 0))
+    assert Desktop._canvas_to_screen(origins, 100, 50) == (100, 50)
+    assert Desktop._canvas_to_screen(origins, 100, 1200) == (2020, 120)
+
+def test_process_screenshot_diff_indexes_text_at_screen_coordinates():
+    """Test that the click_button index holds screen coordinates, not canvas offsets."""
+    desktop = _ocr_desktop([{"text": " Save ", "rect": (2, 3, 12, 8)}])
+    origins = ((0, 1080, 0, 0), (1080, 1080, 1920, 0))  # second monitor to the right
+    desktop._process_screenshot_diff(np.zeros((20, 30, 3), dtype=np.uint8), 1, [], 100, 1100, 30, 20, origins)
+    assert desktop._find_text_in_last_ocr("SAVE") == {"x": 2022, "y": 23, "width": 10, "height": 5}
+
+def test_find_text_in_last_ocr_expires_after_ttl():
+    """Test that cached OCR text is found case-insensitively and ignored once stale."""
+    rect = {"x": 1, "y": 2, "width": 3, "height": 4}
+    desktop = _bare_desktop(lock=threading.Lock(), _last_ocr=None)
+    assert desktop._find_text_in_last_ocr("ok") is None, "No OCR result yet"
+    desktop._last_ocr = (time.monotonic(), {"ok": rect})
+    assert desktop._find_text_in_last_ocr("OK") == rect
+    assert desktop._find_text_in_last_ocr("cancel") is None
+    desktop._last_ocr = (time.monotonic() - 2 * _OCR_CACHE_TTL, {"ok": rect})
+    assert desktop._find_text_in_last_ocr("ok") is None, "Stale OCR results should not be used"
+
+def test_find_wmctrl_window_matches_unpadded_xprop_id():
+    """Test that the focused window id from xprop is found in `wmctrl -lG` output."""
+    output = (
+        b"0x01e00003 -1 0    0    1920 32   myhost Top Panel\n"
+        b"0x02a00007  0 100  200  800  600  myhost Editor\n"
+    )
+    match = _find_wmctrl_window(output, "0x2a00007")
+    assert match is not None and match.group(2, 3, 4, 5) == (b"100", b"200", b"800", b"600")
+    assert _find_wmctrl_window(output, "0x5") is None
+
+def test_wmctrl_regex_parses_geometry():
+    """Test _WMCTRL_RE on `wmctrl -lG` lines, including sticky windows and empty titles."""
+    output = (
+        b"0x01e00003 -1 0    0    1920 32   myhost Top Panel\n"
+        b"0x02a00007  0 100  200  800  600  myhost \n"
+        b"0x02a00009  0 -8   -30  640  480  N/A\n"
+        b"0x02a00008  1 10   20   1024 768  myhost Terminal \xe2\x80\x94 bash\n"
+    )
+    parsed = [match.groups() for match in _WMCTRL_RE.finditer(output)]
+    assert parsed == [
+        (b"0x01e00003", b"0", b"0", b"1920", b"32", b"Top Panel"),
+        (b"0x02a00007", b"100", b"200", b"800", b"600", b""),
+        (b"0x02a00009", b"-8", b"-30", b"640", b"480", b""),
+        (b"0x02a00008", b"10", b"20", b"1024", b"768", "Terminal \u2014 bash".encode("utf-8")),
+    ], f"Unexpected wmctrl parse: {parsed}"
+
+def _input_desktop():
+    """Return a bare Desktop with an empty input ring buffer."""
+    return _bare_desktop(_input_buf=collections.deque(maxlen=16), _pending_key=None, _key_lock=threading.Lock())
+
+def test_save_user_input_drains_raw_events():
+    """Test that saving a snapshot drains the ring buffer and returns the raw event tuples."""
+    desktop = _input_desktop()
+    events = [(_INPUT_KEYBOARD, "'a'", 0, 0, 1, 1), (_INPUT_MOUSE, "click", 5, 6, 2, 1)]
+    desktop._input_buf.extend(events)
+    assert desktop._save_user_input() == events
+    assert desktop._save_user_input() == [], "Drained events should not be returned twice"
+
+def test_format_user_inputs_builds_event_dicts():
+    """Test that raw input tuples are formatted into the stored JSON structure."""
+    time_ns = 1_700_000_000_123_456_789
+    formatted = Desktop._format_user_inputs([
+        (_INPUT_KEYBOARD, "'a'", 0, 0, time_ns, 3),
+        (_INPUT_MOUSE, "click", 5, 6, time_ns, 1),
+    ])
+    timestamp = datetime.fromtimestamp(time_ns / 1e9).isoformat()
+    assert formatted == [
+        {"type": "keyboard", "value": "'a'", "repeat": 3, "timestamp": timestamp},
+        {"type": "mouse", "value": "click", "position": {"x": 5, "y": 6}, "timestamp": timestamp},
+    ], f"Unexpected formatted inputs {formatted}"
+
+def _diff_desktop(small_height, small_width):
+    """Return a bare Desktop whose diff buffers fit frames of the given detection size."""
+    desktop = _bare_desktop()
+    desktop._reset_diff_buffers(np.zeros((small_height * _DIFF_SCALE, small_width * _DIFF_SCALE, 3), dtype=np.uint8))
+    return desktop
+
+def _diff_frames():
+    """Return a base frame and a changed copy with a known box and changed pixel count."""
+    base = np.zeros((40, 60, 3), dtype=np.uint8)
+    new = base.copy()
+    new[10:20, 30:45] = 255              # 150 pixels with every channel changed
+    new[25, 5, 1] = 200                  # 1 pixel with a single channel changed
+    new[5, 50, 2] = _DIFF_THRESHOLD      # not above the threshold, ignored
+    return base, new
+
+def test_diff_bbox_opencv(monkeypatch):
+    """Test that the OpenCV reductions locate the changed box and count changed pixels."""
+    monkeypatch.setattr(sys.modules[Desktop.__module__], "_diff_bbox_kernel", None)
+    desktop = _diff_desktop(40, 60)
+    base, new = _diff_frames()
+    assert desktop._diff_bbox(base, base.copy()) == (0, 0, 0, 0, 0), "Identical frames should have no diff"
+    assert desktop._diff_bbox(base, new) == (5, 10, 40, 16, 151), f"Unexpected diff {desktop._diff_bbox(base, new)}"
+
+@pytest.mark.skipif(_diff_bbox_kernel is None, reason="numba is not installed")
+def test_diff_bbox_numba_matches_opencv(monkeypatch):
+    """Test that the fused numba kernel returns the same box and count as the OpenCV path."""
+    desktop = _diff_desktop(40, 60)
+    base, new = _diff_frames()
+    numba_result = tuple(int(value) for value in desktop._diff_bbox(base, new))
+    monkeypatch.setattr(sys.modules[Desktop.__module__], "_diff_bbox_kernel", None)
+    assert numba_result == desktop._diff_bbox(base, new) == (5, 10, 40, 16, 151), \
+        f"numba returned {numba_result}"
+
+def _migrated_legacy_database(timestamp, position):
+    """Return a bare Desktop over an in-memory database with the original schema, after migration."""
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    conn.execute("""
+        CREATE TABLE snapshots (
+            id INTEGER PRIMARY KEY,
+            type TEXT,
+            timestamp TEXT,
+            data BLOB,
+            position TEXT,
+            text TEXT,
+            user_input TEXT
+        )
+    """)
+    conn.execute(
+        "INSERT INTO snapshots (type, timestamp, data, position, text, user_input) VALUES (?, ?, ?, ?, ?, ?)",
+        ("desktop_screenshot", timestamp, b"", position, "[]", "[]")
+    )
+    desktop = _bare_desktop(conn=conn)
+    desktop._migrate_database()
+    desktop._migrate_database()  # already migrated: a no-op
+    return desktop
+
+def test_migrate_database_backfills_ts_ns_from_local_timestamps():
+    """Test that legacy naive local-time timestamps are backfilled into ts_ns as epoch nanoseconds."""
+    legacy_timestamp = "2024-01-01T12:00:00.123"
+    desktop = _migrated_legacy_database(legacy_timestamp, None)
+    ts_ns, = desktop.conn.execute("SELECT ts_ns FROM snapshots").fetchone()
+    expected_ns = round(datetime.fromisoformat(legacy_timestamp).timestamp() * 1000) * 1_000_000
+    assert ts_ns == expected_ns, f"Expected ts_ns {expected_ns}, got {ts_ns}"
+    indexes = {row[1] for row in desktop.conn.execute("PRAGMA index_list(snapshots)")}
+    assert "idx_snapshots_ts_ns" in indexes, "The ts_ns index should be created"
+
+def test_migrate_database_backfills_position_columns():
+    """Test that the legacy JSON position is backfilled into the x, y, w and h columns."""
+    desktop = _migrated_legacy_database("2024-01-01T12:00:00", '{"x": 1, "y": 2, "width": 3, "height": 4}')
+    position = desktop.conn.execute("SELECT x, y, w, h FROM snapshots").fetchone()
+    assert position == (1, 2, 3, 4), f"Expected position (1, 2, 3, 4), got {position}"
+
+def test_scale_bbox_pads_and_clamps():
+    """Test that _scale_bbox maps a detection-scale box to padded full resolution, clamped to the frame."""
+    desktop = _diff_desktop(40, 60)
+    assert desktop._scale_bbox(10, 5, 4, 2) == (
+        10 * _DIFF_SCALE - _DIFF_PAD,
+        5 * _DIFF_SCALE - _DIFF_PAD,
+        4 * _DIFF_SCALE + 2 * _DIFF_PAD,
+        2 * _DIFF_SCALE + 2 * _DIFF_PAD,
+    )
+    assert desktop._scale_bbox(0, 0, 60, 40) == (0, 0, 60 * _DIFF_SCALE, 40 * _DIFF_SCALE), \
+        "A full-frame box should be clamped to the frame"
+
+def _gated_diff_desktop():
+    """Return a bare Desktop primed with a black base frame and no free OCR slot."""
+    desktop = _bare_desktop(base_image=None, _diff_frame_shape=None, _ocr_slots=threading.BoundedSemaphore(1),
+                            _min_diff_area=_MIN_DIFF_AREA, _min_diff_density=_MIN_DIFF_DENSITY)
+    desktop._ocr_slots.acquire()  # saturated: a frame passing the gates stops here
+    frame = np.zeros((100 * _DIFF_SCALE, 100 * _DIFF_SCALE, 3), dtype=np.uint8)
+    desktop._save_screenshot_diff(frame)
+    return desktop, frame
+
+def _change_square(frame, side):
+    changed = frame.copy()
+    changed[100:100 + side, 100:100 + side] = 255
+    return changed
+
+def test_save_screenshot_diff_absorbs_skipped_changes():
+    """Test that a change too small to record, measured before padding, becomes part of the base."""
+    desktop, frame = _gated_diff_desktop()
+    side = 8 * _DIFF_SCALE  # 32x32 px: below the area gate, though it would pass once padded
+    assert side * side < _MIN_DIFF_AREA < (side + 2 * _DIFF_PAD) ** 2
+    desktop._save_screenshot_diff(_change_square(frame, side))
+    cell = 100 // _DIFF_SCALE
+    assert desktop.base_image[cell, cell].max() == 255, "Skipped change should be absorbed into the base"
+
+def test_save_screenshot_diff_keeps_base_for_pending_changes():
+    """Test that a change passing the gates but blocked on OCR leaves the base for the next frame."""
+    desktop, frame = _gated_diff_desktop()
+    side = 12 * _DIFF_SCALE  # 48x48 px: above the area gate
+    assert side * side >= _MIN_DIFF_AREA
+    desktop._save_screenshot_diff(_change_square(frame, side))
+    assert desktop.base_image.max() == 0, "A change waiting for OCR should not be absorbed"
+
+def test_serialize_row_encodes_ocr_and_inputs():
+    """Test that queued rows are JSON-encoded on the writer side, numpy scalars included."""
+    time_ns = 1_700_000_000_000_000_000
+    row = (time_ns, "desktop_screenshot", b"blob", 1, 2, 3, 4,
+           [{"text": "OK", "rect": {"x": np.int32(5), "y": 6, "width": 7, "height": 8}}],
+           [(_INPUT_MOUSE, "click", 5, 6, time_ns, 1)])
+    serialized = Desktop._serialize_row(_bare_desktop(), row)
+    assert serialized[:7] == row[:7], "Scalar columns should pass through unchanged"
+    assert serialized[7] == '[{"text":"OK","rect":{"x":5,"y":6,"width":7,"height":8}}]'
+    assert '"type":"mouse"' in serialized[8] and '"position":{"x":5,"y":6}' in serialized[8]
+
+def test_db_writer_survives_unserializable_rows(snapshot_db_desktop):
+    """Test that a row that cannot be encoded is dropped without stopping the writer."""
+    desktop = snapshot_db_desktop
+    desktop._write_queue.put(_queued_row(1, [{"text": object()}]))
+    desktop._write_queue.put(_queued_row(2))
+    _stop_writer(desktop)
+    stored = [row[0] for row in desktop.conn.execute("SELECT ts_ns FROM snapshots")]
+    assert stored == [2], f"Only the encodable row should be stored, got {stored}"
+
+def test_key_auto_repeat_is_coalesced():
+    """Test that rapid presses of one key become a single event with a repeat count."""
+    desktop = _input_desktop()
+    start = time.time_ns() - 10 * _KEY_IDLE_FLUSH_NS
+    step = _KEY_REPEAT_WINDOW_NS // 2
+    assert desktop._record_key_press("'a'", start)
+    assert not desktop._record_key_press("'a'", start + step)
+    assert not desktop._record_key_press("'a'", start + 2 * step)
+    assert desktop._record_key_press("'b'", start + 3 * step), "A different key should start a new event"
+    assert desktop._record_key_press("'b'", start + 3 * step + 2 * _KEY_REPEAT_WINDOW_NS), \
+        "A press after the repeat window should start a new event"
+    assert list(desktop._input_buf) == [
+        (_INPUT_KEYBOARD, "'a'", 0, 0, start, 3),
+        (_INPUT_KEYBOARD, "'b'", 0, 0, start + 3 * step, 1),
+    ]
+
+def test_save_user_input_flushes_only_idle_pending_key():
+    """Test that a pending key is flushed into a snapshot only once it has been idle long enough."""
+    desktop = _input_desktop()
+    desktop._record_key_press("'a'", time.time_ns())
+    assert desktop._save_user_input() == [], "A key that may still repeat should stay pending"
+    desktop._pending_key[2] -= _KEY_IDLE_FLUSH_NS
+    first_ns = desktop._pending_key[3]
+    assert desktop._save_user_input() == [(_INPUT_KEYBOARD, "'a'", 0, 0, first_ns, 1)]